@@ -3,7 +3,7 @@ import time
 # Savannah's 'Tropical sunset' palette
 import copy
 
-from support.hue import hue
+from support.hue import get_light_ids, set_lights, PRIORITY_BULK
 from support.logger import get_logger
 
 FRAME_TIME_S = 10
@@ -31,7 +31,7 @@ counter = 0
 
 def assign_colors(offset: int = 0):
     colors_idx = offset
-    for light in hue.get_light_objects(mode='id'):
+    for light in get_light_ids():
 
         LIGHT_TO_COLOR_IDX[light] = colors_idx
         #logger.info("Light %d will have color %d :  %s" % (light, colors_idx, COLORS[colors_idx]))
@@ -55,6 +55,6 @@ while True:
         command_copy = copy.deepcopy(command)
         command_copy['xy'] = COLORS[colors_idx]
         #logger.info("Animating light to %s" % command_copy)
-        hue.set_light(light, command_copy)
+        set_lights(light, command_copy, PRIORITY_BULK)
     #logger.info("Sleeping %d s" % FRAME_TIME_S)
     time.sleep(FRAME_TIME_S + 1)
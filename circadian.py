@@ -2,44 +2,93 @@ import time
 
 import copy
 
-from support.color import get_next_circadian_color
-from support.env import get_room_occupied
-from support.hue import command_all_lights, hue
+from support.color import get_continuous_circadian_command, get_next_circadian_color, log_circadian_schedule
+from support import env
+from support.hue import command_all_lights, provision_room_groups, PRIORITY_BULK
 from support.logger import get_logger
 from support.room import LightsOnDuringDayRoom
 from support.time_utils import get_local_time
-from settings import ROOMS
+from settings import CIRCADIAN_CONTINUOUS, CIRCADIAN_UPDATE_INTERVAL_S, ROOMS
 
 # Logging
 logger = get_logger("circadian")
 
-while 1:
-    now = get_local_time()
-    next_color_date, next_color = get_next_circadian_color(date=now)
 
-    sleep_time_s = (next_color_date - now).seconds
-    logger.info("Sleeping until %s at %s", next_color.name, next_color_date.strftime('%Y/%m/%d %I:%M:%S %p'))
-    time.sleep(sleep_time_s + 30)  # Add padding to compensate for sleep inaccuracy
-    logger.info("Adjusting hue for %s", next_color.name)
-    command = next_color.apply_to_command({'transitiontime': 120 * 10})  # 120 s transition
+def apply_circadian_color(color):
+    logger.info("Adjusting hue for %s", color.name)
+    command = color.apply_to_command({'transitiontime': 120 * 10})  # 120 s transition
 
-    if next_color.name == 'Day':
-        lights = []
+    if color.name == 'Day':
         for room in ROOMS:
             if not isinstance(room, LightsOnDuringDayRoom):
-                lights += room.lights
-        hue.set_light(lights, command)
-    elif next_color.name == 'Late Afternoon':
+                room.update(command, PRIORITY_BULK)
+    elif color.name == 'Late Afternoon':
         # This transitions the lights from off to on, so we should turn on rooms
         # that are occupied (in addition to applying the circadian hue)
         on_plus_command = copy.deepcopy(command)
         on_plus_command['on'] = True
 
+        snapshot = env.snapshot()
         for room in ROOMS:
-            if get_room_occupied(room.name):
+            if snapshot.get_room_occupied(room.name):
                 logger.info("Turning on occupied room %s for Late Afternoon transition" % room.name)
-                room.update(on_plus_command)
+                room.update(on_plus_command, PRIORITY_BULK)
             else:
-                room.update(command)
+                room.update(command, PRIORITY_BULK)
     else:
-        command_all_lights(command)
+        command_all_lights(command, PRIORITY_BULK)
+
+
+def update_lit_rooms(command: dict):
+    """
+    Send command to each lit room, spread evenly over CIRCADIAN_UPDATE_INTERVAL_S so the bridge
+    sees a trickle of commands rather than a burst
+    """
+    room_interval_s = CIRCADIAN_UPDATE_INTERVAL_S / len(ROOMS)
+    for room in ROOMS:
+        started = time.time()
+        if len(room.lights) > 0 and room.is_lit():
+            room.update(command, PRIORITY_BULK)
+        time.sleep(max(0.0, room_interval_s - (time.time() - started)))
+
+
+def run_discrete():
+    while 1:
+        now = get_local_time()
+        next_color_date, next_color = get_next_circadian_color(date=now)
+
+        sleep_time_s = (next_color_date - now).seconds
+        logger.info("Sleeping until %s at %s", next_color.name, next_color_date.strftime('%Y/%m/%d %I:%M:%S %p'))
+        time.sleep(sleep_time_s + 30)  # Add padding to compensate for sleep inaccuracy
+        apply_circadian_color(next_color)
+
+
+def run_continuous():
+    next_color_date, next_color = get_next_circadian_color()
+
+    while 1:
+        now = get_local_time()
+        if now >= next_color_date:
+            # Events still switch lights on and off, and set every light, lit or not
+            apply_circadian_color(next_color)
+            next_color_date, next_color = get_next_circadian_color(date=now)
+            time.sleep(CIRCADIAN_UPDATE_INTERVAL_S)
+            continue
+
+        command = get_continuous_circadian_command(now)
+        if command.get('on', True):  # A lights-off color is left to its event, not re-sent every interval
+            command['transitiontime'] = CIRCADIAN_UPDATE_INTERVAL_S * 10
+            update_lit_rooms(command)
+        else:
+            time.sleep(CIRCADIAN_UPDATE_INTERVAL_S)
+
+
+# On startup, print out all circadian event times
+log_circadian_schedule()
+
+provision_room_groups({room.name: room.lights for room in ROOMS})
+
+if CIRCADIAN_CONTINUOUS:
+    run_continuous()
+else:
+    run_discrete()
@@ -0,0 +1,333 @@
+"""
+A local stand-in for the Hue bridge, for exercising and benchmarking light control without hardware.
+
+Serves the parts of the Hue API we use, models the bridge's per-second command budgets, and can
+inject latency, jitter, errors and timeouts. Every request is recorded.
+
+    python3 hue_emulator.py --port 8000 --latency-ms 40 --jitter-ms 20
+
+Point our processes at it with the HUE_BRIDGE_IP environment variable:
+
+    HUE_BRIDGE_IP=127.0.0.1:8000 python3 circadian.py
+
+Recorded requests and latency statistics are served at /emulator/commands and /emulator/stats.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+USERNAME = 'emulator'
+
+ERROR_UNAUTHORIZED = 1
+ERROR_NOT_AVAILABLE = 3
+ERROR_NOT_MODIFIABLE_WHILE_OFF = 201
+ERROR_INTERNAL = 901
+
+# Attributes a light's state PUT may set
+STATE_ATTRIBUTES = ('on', 'bri', 'xy', 'ct', 'hue', 'sat', 'alert', 'effect')
+
+
+class TokenBucket:
+    def __init__(self, rate_per_s: float):
+        self.rate_per_s = rate_per_s
+        self.tokens = rate_per_s
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate_per_s, self.tokens + (now - self.updated) * self.rate_per_s)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class EmulatedBridge:
+    def __init__(self, light_count: int, light_commands_per_s: float, group_commands_per_s: float,
+                 latency_s: float, jitter_s: float, error_rate: float, timeout_rate: float, timeout_s: float,
+                 record_path: str = None):
+        self.lights = {}
+        for light_id in range(1, light_count + 1):
+            self.lights[str(light_id)] = {
+                'state': {'on': False, 'bri': 254, 'xy': [0.4506, 0.4081], 'ct': 366, 'hue': 8402, 'sat': 140,
+                          'alert': 'none', 'effect': 'none', 'colormode': 'xy', 'reachable': True},
+                'type': 'Extended color light',
+                'name': 'Light %d' % light_id,
+                'modelid': 'LCT007',
+            }
+        self.groups = {}
+        self.next_group_id = 1
+        self.state_lock = threading.Lock()
+
+        self.light_bucket = TokenBucket(light_commands_per_s)
+        self.group_bucket = TokenBucket(group_commands_per_s)
+
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_s = timeout_s
+
+        self.commands = []  # Every request, as a dict
+        self.commands_lock = threading.Lock()
+        self.record_file = open(record_path, 'a') if record_path is not None else None
+
+    def handle(self, method: str, path: str, body) -> (int, object, str):
+        """
+        :return: the HTTP status, the JSON response and the outcome recorded
+        """
+        if method == 'POST' and path in ('/api', '/api/'):
+            return 200, [{'success': {'username': USERNAME}}], 'ok'
+
+        match = re.match(r'^/api/([^/]+)(/.*)?$', path)
+        if match is None:
+            return 404, None, 'not_found'
+        if match.group(1) != USERNAME:
+            return 200, [_error(ERROR_UNAUTHORIZED, path, 'unauthorized user')], 'unauthorized'
+        resource = (match.group(2) or '').rstrip('/')
+
+        if method == 'PUT' and re.match(r'^/(lights/\d+/state|groups/\d+/action)$', resource):
+            bucket = self.light_bucket if resource.startswith('/lights') else self.group_bucket
+            if not bucket.take():
+                return 200, [_error(ERROR_INTERNAL, resource, 'Internal error, 503')], 'rate_limited'
+
+        if random.random() < self.error_rate:
+            return 200, [_error(ERROR_INTERNAL, resource, 'Internal error, 500')], 'error'
+
+        with self.state_lock:
+            return self._handle_resource(method, resource, body)
+
+    def _handle_resource(self, method: str, resource: str, body) -> (int, object, str):
+        if method == 'GET' and resource == '':
+            return 200, {'lights': self.lights, 'groups': self.groups, 'config': _config()}, 'ok'
+        if method == 'GET' and resource == '/config':
+            return 200, _config(), 'ok'
+        if method == 'GET' and resource == '/lights':
+            return 200, self.lights, 'ok'
+        if method == 'GET' and resource == '/groups':
+            return 200, self.groups, 'ok'
+
+        match = re.match(r'^/lights/(\d+)(/state)?$', resource)
+        if match is not None:
+            light = self.lights.get(match.group(1))
+            if light is None:
+                return 200, [_error(ERROR_NOT_AVAILABLE, resource, 'resource, %s, not available' % resource)], 'ok'
+            if method == 'GET' and match.group(2) is None:
+                return 200, light, 'ok'
+            if method == 'PUT' and match.group(2) is not None:
+                return 200, self._set_state([match.group(1)], resource, body), 'ok'
+
+        if method == 'POST' and resource == '/groups':
+            group_id = str(self.next_group_id)
+            self.next_group_id += 1
+            self.groups[group_id] = {'name': body.get('name', 'Group %s' % group_id),
+                                     'lights': [str(light) for light in body.get('lights', [])],
+                                     'type': body.get('type', 'LightGroup'),
+                                     'action': {'on': False}}
+            return 200, [{'success': {'id': group_id}}], 'ok'
+
+        match = re.match(r'^/groups/(\d+)(/action)?$', resource)
+        if match is not None:
+            group_id = match.group(1)
+            if group_id == '0':
+                group = {'name': 'All lights', 'lights': sorted(self.lights.keys(), key=int), 'type': 'LightGroup'}
+            else:
+                group = self.groups.get(group_id)
+            if group is None:
+                return 200, [_error(ERROR_NOT_AVAILABLE, resource, 'resource, %s, not available' % resource)], 'ok'
+            if method == 'GET' and match.group(2) is None:
+                return 200, group, 'ok'
+            if method == 'PUT' and match.group(2) is not None:
+                return 200, self._set_state(group['lights'], resource, body), 'ok'
+            if method == 'PUT' and match.group(2) is None:
+                result = []
+                for attribute in ('name', 'lights'):
+                    if attribute in body:
+                        value = body[attribute] if attribute == 'name' else [str(light) for light in body[attribute]]
+                        group[attribute] = value
+                        result.append({'success': {'/groups/%s/%s' % (group_id, attribute): value}})
+                return 200, result, 'ok'
+            if method == 'DELETE' and match.group(2) is None:
+                del self.groups[group_id]
+                return 200, [{'success': '/groups/%s deleted' % group_id}], 'ok'
+
+        return 404, None, 'not_found'
+
+    def _set_state(self, light_ids: list, resource: str, command: dict) -> list:
+        """
+        Apply a command to lights as the bridge does: attributes other than 'on' can't change while a light is off
+        """
+        result = []
+        turning_on = command.get('on') is True
+        for attribute, value in command.items():
+            if attribute == 'transitiontime':
+                result.append({'success': {'%s/%s' % (resource, attribute): value}})
+                continue
+            if attribute not in STATE_ATTRIBUTES:
+                result.append(_error(6, '%s/%s' % (resource, attribute), 'parameter, %s, not available' % attribute))
+                continue
+            off = [light_id for light_id in light_ids if not self.lights[light_id]['state']['on']]
+            if attribute != 'on' and not turning_on and len(off) == len(light_ids) and len(light_ids) > 0:
+                result.append(_error(ERROR_NOT_MODIFIABLE_WHILE_OFF, '%s/%s' % (resource, attribute),
+                                     'parameter, %s, is not modifiable. Device is set to off.' % attribute))
+                continue
+            for light_id in light_ids:
+                state = self.lights[light_id]['state']
+                if attribute == 'on' or state['on'] or turning_on:
+                    state[attribute] = value
+            result.append({'success': {'%s/%s' % (resource, attribute): value}})
+        return result
+
+    def delay(self) -> str:
+        """
+        Sleep for the configured latency, or long enough for the client to time out
+        :return: 'timeout' if the request should be treated as timed out, otherwise None
+        """
+        if random.random() < self.timeout_rate:
+            time.sleep(self.timeout_s)
+            return 'timeout'
+        time.sleep(max(0.0, self.latency_s + random.uniform(-self.jitter_s, self.jitter_s)))
+        return None
+
+    def record(self, command: dict):
+        with self.commands_lock:
+            self.commands.append(command)
+            if self.record_file is not None:
+                self.record_file.write(json.dumps(command) + '\n')
+                self.record_file.flush()
+
+    def stats(self) -> dict:
+        with self.commands_lock:
+            commands = list(self.commands)
+
+        stats = {'requests': len(commands), 'outcomes': {}, 'commands_per_s': 0.0, 'latency_ms': {}}
+        for command in commands:
+            stats['outcomes'][command['outcome']] = stats['outcomes'].get(command['outcome'], 0) + 1
+
+        puts = [command for command in commands if command['method'] == 'PUT']
+        if len(puts) > 1:
+            span_s = puts[-1]['received'] - puts[0]['received']
+            stats['commands_per_s'] = len(puts) / span_s if span_s > 0 else float(len(puts))
+
+        latencies = sorted(command['latency_ms'] for command in commands)
+        if len(latencies) > 0:
+            stats['latency_ms'] = {'min': latencies[0],
+                                   'p50': latencies[len(latencies) // 2],
+                                   'p99': latencies[min(len(latencies) - 1, int(len(latencies) * .99))],
+                                   'max': latencies[-1]}
+        return stats
+
+
+def _error(error_type: int, address: str, description: str) -> dict:
+    return {'error': {'type': error_type, 'address': address, 'description': description}}
+
+
+def _config() -> dict:
+    return {'name': 'Emulated bridge', 'apiversion': '1.16.0', 'swversion': '1709131301'}
+
+
+class EmulatorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive, as the real bridge does
+    bridge = None  # The EmulatedBridge, set before serving
+
+    def do_GET(self):
+        self._serve('GET')
+
+    def do_PUT(self):
+        self._serve('PUT')
+
+    def do_POST(self):
+        self._serve('POST')
+
+    def do_DELETE(self):
+        self._serve('DELETE')
+
+    def log_message(self, format, *args):
+        pass  # Every request is recorded instead
+
+    def _serve(self, method: str):
+        received = time.time()
+        length = int(self.headers.get('Content-Length', 0))
+        raw_body = self.rfile.read(length) if length > 0 else b''
+
+        if method == 'GET' and self.path == '/emulator/stats':
+            return self._respond(200, self.bridge.stats())
+        if method == 'GET' and self.path == '/emulator/commands':
+            with self.bridge.commands_lock:
+                return self._respond(200, list(self.bridge.commands))
+
+        try:
+            body = json.loads(raw_body.decode('utf-8')) if raw_body else {}
+        except ValueError:
+            body = None
+
+        if self.bridge.delay() == 'timeout':
+            outcome, status, response = 'timeout', 200, [_error(ERROR_INTERNAL, self.path, 'Internal error, 504')]
+        elif body is None:
+            outcome, status, response = 'error', 200, [_error(2, self.path, 'body contains invalid json')]
+        else:
+            status, response, outcome = self.bridge.handle(method, self.path, body)
+
+        self.bridge.record({'received': received,
+                            'method': method,
+                            'path': self.path,
+                            'body': body,
+                            'outcome': outcome,
+                            'latency_ms': (time.time() - received) * 1000})
+        self._respond(status, response)
+
+    def _respond(self, status: int, response):
+        payload = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulate a Hue bridge")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--lights', type=int, default=32, help="number of lights, with ids from 1")
+    parser.add_argument('--light-rate', type=float, default=10, help="light commands accepted per second")
+    parser.add_argument('--group-rate', type=float, default=1, help="group commands accepted per second")
+    parser.add_argument('--latency-ms', type=float, default=0, help="added to every request")
+    parser.add_argument('--jitter-ms', type=float, default=0, help="latency varies uniformly by up to this")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests answered with an error")
+    parser.add_argument('--timeout-rate', type=float, default=0, help="fraction of requests answered late")
+    parser.add_argument('--timeout-s', type=float, default=10, help="how late timed out requests are answered")
+    parser.add_argument('--record', help="append every request to this file as JSON lines")
+    args = parser.parse_args()
+
+    EmulatorRequestHandler.bridge = EmulatedBridge(light_count=args.lights,
+                                                   light_commands_per_s=args.light_rate,
+                                                   group_commands_per_s=args.group_rate,
+                                                   latency_s=args.latency_ms / 1000.0,
+                                                   jitter_s=args.jitter_ms / 1000.0,
+                                                   error_rate=args.error_rate,
+                                                   timeout_rate=args.timeout_rate,
+                                                   timeout_s=args.timeout_s,
+                                                   record_path=args.record)
+
+    server = ThreadingHTTPServer((args.host, args.port), EmulatorRequestHandler)
+    print("Emulating a Hue bridge with %d lights at %s:%d, username '%s'" %
+          (args.lights, args.host, args.port, USERNAME))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(EmulatorRequestHandler.bridge.stats(), indent=2))
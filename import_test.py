@@ -0,0 +1,49 @@
+"""
+Checks importing the support modules does no network or database I/O, and takes under IMPORT_BUDGET_S,
+with the bridge and database unreachable. Exits non-zero if not::
+
+    python3 import_test.py
+"""
+
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+IMPORT_BUDGET_S = 1.0
+MODULES = ('support.hue', 'support.env', 'support.color')
+
+os.environ['HUE_BRIDGE_IP'] = '192.0.2.1'  # TEST-NET-1: reserved, never reachable
+
+io_attempts = []
+
+
+def refuse(description: str):
+    def refused(*args, **kwargs):
+        io_attempts.append(description)
+        raise OSError("%s attempted during import" % description)
+    return refused
+
+
+socket.socket.connect = refuse("socket connect")
+socket.getaddrinfo = refuse("DNS lookup")
+sqlite3.connect = refuse("sqlite3 connect")
+
+started = time.time()
+for module in MODULES:
+    try:
+        __import__(module)
+    except OSError as e:
+        print("FAIL: importing %s raised %s" % (module, e))
+        sys.exit(1)
+elapsed_s = time.time() - started
+
+print("Imported %s in %.3f s" % (", ".join(MODULES), elapsed_s))
+if len(io_attempts) > 0:
+    print("FAIL: I/O during import: %s" % ", ".join(io_attempts))
+    sys.exit(1)
+if elapsed_s > IMPORT_BUDGET_S:
+    print("FAIL: import took longer than %.1f s" % IMPORT_BUDGET_S)
+    sys.exit(1)
+print("OK")
@@ -1,13 +1,16 @@
+import asyncio
+import concurrent.futures
 import datetime
-import threading
 import time
 
-#import RPi.GPIO as GPIO
 import settings
 
-from support.env import set_motion_enabled, is_motion_enabled, set_room_occupied, get_room_occupied
+from support.env import set_motion_enabled, is_motion_enabled, snapshot, \
+    record_sensor_event, EVENT_MOTION, EVENT_LUMINANCE, EVENT_TEMPERATURE
+from support.hue import provision_room_groups
 from support.logger import get_logger
 from support.room import PIN_NO_PIN, PIN_EXTERNAL_SENSOR, Room
+from support.sensors import BleSource, GpioSource, SensorBus, SensorEvent, ZigbeeUdpSource
 from support.time_utils import get_local_time
 
 # Logging
@@ -29,6 +32,22 @@ EXITED_ROOMS = set([])  # Rooms where an exit event occurred
 # Even an allegedly occupied room should be shut off after no motion for this period
 OCCUPIED_ROOM_MOTION_TIMEOUT = datetime.timedelta(hours=2)
 
+# How soon to check again a room that was due but couldn't time out, e.g: in party mode or with motion disabled.
+# Also how often rooms sensed externally are polled, as their sensors can't tell us of motion, and how often
+# rooms without a timer are swept, in case something other than motion lit them
+MOTION_RECHECK_INTERVAL = datetime.timedelta(minutes=1)
+
+ZIGBEE_UDP_IP = "127.0.0.1"
+
+# The event loop receives sensor events and keeps room timers. Handlers, which block on Hue and SQLite,
+# run on one worker in arrival order: the loop never waits on the bridge, and room state never races
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+sensor_bus = SensorBus(loop)  # Every sensor source publishes here
+state_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+room_timers = {}  # Room name -> asyncio.TimerHandle of its next timeout check. Only used on the loop
+
 for idx, room in enumerate(settings.ROOMS):
     ROOM_NAME_TO_IDX[room.name] = idx
 
@@ -46,6 +65,11 @@ for idx, room in enumerate(settings.ROOMS):
     elif pin != PIN_NO_PIN:
         PIN_TO_ROOM[room.motion_pin] = room
 
+# Rooms whose lights time out without motion: those with a sensor of any kind
+MOTION_ROOMS = list(PIN_TO_ROOM.values()) + EXTERNAL_SENSOR_ROOMS + \
+               [settings.ROOMS[ROOM_NAME_TO_IDX[room_name]]
+                for room_name in list(settings.BLE_SENSORS.values()) + list(settings.GPIO_SENSORS.values())]
+
 logger.info("Prepped exit map %s", EXIT_ROOM_NAME_TO_SOURCE_ROOM_NAMES)
 
 
@@ -73,18 +97,18 @@ def corroborates_exit(exit_dst_room: Room, exit_src_room: Room):
 
     return result
 
-def on_gpio_motion(triggered_pin: int):
-    # TODO : Currently motion pins are used as zigbee addresses
-    room = PIN_TO_ROOM[triggered_pin]
-#    is_motion_start = GPIO.input(triggered_pin)
-#    on_motion(room, is_motion_start)
-
-def on_motion(room: Room, is_motion_start: bool):
-    now = get_local_time()
+def on_motion(room: Room, is_motion_start: bool, now: datetime = None):
+    """
+    :param now: when the motion was sensed. If None, now
+    """
+    if now is None:
+        now = get_local_time()
 
     logger.info("Motion %s in %s" %
                 (("started" if is_motion_start else "stopped"), room.name))
 
+    record_sensor_event(room.name, EVENT_MOTION, 1 if is_motion_start else 0, now)
+
     # Ignore event if motion disabled
     if not is_motion_enabled():
         logger.info("Motion disabled. Ignoring event")
@@ -100,7 +124,7 @@ def on_motion(room: Room, is_motion_start: bool):
         modified_occupancy = (room not in OCCUPIED_ROOMS) or (room in EXITED_ROOMS)
         OCCUPIED_ROOMS.add(room)
         EXITED_ROOMS.discard(room)
-        set_room_occupied(room.name, True)
+        room.set_occupied(True)
 
         exit_src_rooms = EXIT_ROOM_NAME_TO_SOURCE_ROOM_NAMES.get(room.name, None)
         if is_motion_start and exit_src_rooms is not None:
@@ -113,15 +137,70 @@ def on_motion(room: Room, is_motion_start: bool):
                     modified_occupancy = (exit_src_room in OCCUPIED_ROOMS) or (exit_src_room not in EXITED_ROOMS)
                     EXITED_ROOMS.add(exit_src_room)
                     OCCUPIED_ROOMS.discard(exit_src_room)
-                    set_room_occupied(room.name, False)
+                    exit_src_room.set_occupied(False)
+                    schedule_timeout(exit_src_room, now)  # No longer held on by occupancy
         if modified_occupancy:
             logger.info("Occupied rooms %s" % OCCUPIED_ROOMS)
 
+    schedule_timeout(room, now)
+
+
+def get_timeout_deadline(room: Room, now_date: datetime) -> datetime:
+    """
+    :return: when room may next time out, or None if it can't until more motion
+    """
+    if room in EXTERNAL_SENSOR_ROOMS:
+        # Another process records this room's motion without telling us: poll it
+        return now_date + MOTION_RECHECK_INTERVAL
+
+    last_motion = room.get_last_motion()
+    if room.motion_started or last_motion is None:
+        return None
+
+    deadline = last_motion + room.motion_timeout
+    if deadline <= now_date and room.name in settings.ROOM_GRAPH and room not in EXITED_ROOMS:
+        # Timed out, but held on as occupied. See disable_inactive_lights
+        deadline = last_motion + OCCUPIED_ROOM_MOTION_TIMEOUT
+    return deadline
+
+
+def schedule_timeout(room: Room, now_date: datetime):
+    loop.call_soon_threadsafe(set_room_timer, room.name, get_timeout_deadline(room, now_date))
+
+
+def set_room_timer(room_name: str, deadline: datetime):
+    """
+    Replace the room's timer with one at deadline, or none if deadline is None. Call on the loop
+    """
+    timer = room_timers.pop(room_name, None)
+    if timer is not None:
+        timer.cancel()
 
-def disable_inactive_lights():
+    if deadline is not None:
+        delay_s = max(0.0, deadline.timestamp() - time.time())
+        room_timers[room_name] = loop.call_at(loop.time() + delay_s, on_room_timer, room_name)
+
+
+def on_room_timer(room_name: str):
+    del room_timers[room_name]
+    submit_to_state_executor(check_room_timeout, settings.ROOMS[ROOM_NAME_TO_IDX[room_name]])
+
+
+def check_room_timeout(room: Room):
+    now_date = get_local_time()
+    if is_motion_enabled():
+        disable_inactive_lights([room])
+    else:
+        schedule_recheck(room, now_date)
+    if room in EXTERNAL_SENSOR_ROOMS:
+        schedule_timeout(room, now_date)  # Polled. See get_timeout_deadline
+
+
+def disable_inactive_lights(motion_rooms: [Room]):
+    """
+    Power off those of motion_rooms that timed out, and schedule when the rest may next time out
+    """
     now_date = get_local_time()
-    motion_rooms = list(PIN_TO_ROOM.values())
-    motion_rooms += EXTERNAL_SENSOR_ROOMS
 
     log_msg = "Disable inactive lights report: "
 
@@ -131,6 +210,7 @@ def disable_inactive_lights():
         log_msg += "%s is %s. " % (room.name, "inactive" if inactive else "active")
 
         if not inactive:
+            schedule_recheck(room, now_date)
             continue
 
         # An 'occupied' room has a higher motion timeout. This combats events we can't control.
@@ -145,6 +225,7 @@ def disable_inactive_lights():
                 log_msg += "Inactive Room %s has no exit event but is motionless beyond occupied timeout. Power off. " % room.name
             else:
                 log_msg += "Inactive Room %s has no exit event. Keep on. " % room.name
+                schedule_recheck(room, now_date)
                 continue
         else:
             log_msg += "Inactive Room %s has no exit dst neighbors. Power off. " % room.name
@@ -153,73 +234,120 @@ def disable_inactive_lights():
 
         # Never consider a powered-off room as occupied
         OCCUPIED_ROOMS.discard(room)
-        set_room_occupied(room.name, False)
+        room.set_occupied(False)
     log_msg += "Occupied rooms %s" % OCCUPIED_ROOMS
     logger.info(log_msg)
 
-def monitor_zigbee():
-    import re
-    import socket
-    UDP_IP = "127.0.0.1"
-    UDP_PORT = 5005  # Ugh can't import from python3 land
-    sock = socket.socket(socket.AF_INET,  # Internet
-                         socket.SOCK_DGRAM)  # UDP
-    sock.bind((UDP_IP, UDP_PORT))
-
-    regexp = re.compile(r'^([a-z]+)-(\d+)-(.+)')
-    while 1:
-        data, addr = sock.recvfrom(255)
-        m = regexp.match(data.decode('utf-8'))
-        if m:
-            type = m.group(1)
-            addr = int(m.group(2))
-            val = m.group(3)
-            if addr in PIN_TO_ROOM:
-                room = PIN_TO_ROOM[addr]
-                if type == 'motion':
-                    is_motion_start = int(val) == 1
-                    #logger.info("Got zigbee %s for room %s with value %s",
-                    #            type, room, val)
-                    on_motion(room, is_motion_start)
-                elif type == 'luminance':
-                    luminance_lux = float(val)
-                    room.luminance_lux = luminance_lux
-                elif type == 'temp':
-                    temp_fahrenheit = float(val)
-                    room.temp_fahrenheit = temp_fahrenheit
-                else:
-                    logger.warn("Got zigbee command with unknown type %s", m.group(0))
-            else:
-                logger.warn("Got zigbee command from unknown addr %l", addr)
-        else:
-            logger.info("Got unrecognized zigbee socket data %s", data)
-
-try:
-    # RPi GPIO
-    '''
-    GPIO.setmode(GPIO.BCM)
 
-    for active_pin in PIN_TO_ROOM.keys():
-        GPIO.setup(active_pin, GPIO.IN)
-        GPIO.add_event_detect(active_pin, GPIO.BOTH, callback=on_gpio_motion)
-    '''
+def on_sweep_timer():
+    """
+    Sweep the motion rooms without a timer, and schedule the next sweep. Call on the loop
+    """
+    idle_rooms = [room for room in MOTION_ROOMS if room.name not in room_timers]
+    submit_to_state_executor(sweep_idle_rooms, idle_rooms)
+    loop.call_later(MOTION_RECHECK_INTERVAL.total_seconds(), on_sweep_timer)
 
-    zb = threading.Thread(target=monitor_zigbee)
-    zb.start()
 
-    min_motion_timeout_room = min(settings.ROOMS, key=lambda room: room.motion_timeout)
-    min_motion_timeout = min_motion_timeout_room.motion_timeout
-    logger.info("Min motion timeout %s", str(min_motion_timeout))
+def sweep_idle_rooms(rooms: [Room]):
+    """
+    Time out those of rooms that are lit. Only motion schedules a room's timer, so this catches rooms lit otherwise,
+    e.g: from the web server, at party mode's end or by a circadian event. Run on the state worker
+    """
+    if not is_motion_enabled():
+        return
+    lit_rooms = [room for room in rooms if room.is_lit(wait=False) is not False]  # None: not cached, so maybe lit
+    if len(lit_rooms) > 0:
+        disable_inactive_lights(lit_rooms)
+
+
+def schedule_recheck(room: Room, now_date: datetime):
+    """
+    Schedule room's next timeout after it was due but not powered off. If its deadline is already
+    past, e.g: in party mode, check again after MOTION_RECHECK_INTERVAL
+    """
+    deadline = get_timeout_deadline(room, now_date)
+    if deadline is None:
+        return
+    if deadline <= now_date:
+        deadline = now_date + MOTION_RECHECK_INTERVAL
+    loop.call_soon_threadsafe(set_room_timer, room.name, deadline)
+
+
+def submit_to_state_executor(function: callable, *args):
+    """
+    Run function on the state worker, after all handlers submitted before it
+    """
+    future = state_executor.submit(function, *args)
+    future.add_done_callback(_log_handler_exception)
+
+
+def _log_handler_exception(future: concurrent.futures.Future):
+    if future.exception() is not None:
+        exception = future.exception()
+        logger.error("Handler failed", exc_info=(type(exception), exception, exception.__traceback__))
+
+
+def on_sensor_event(event: SensorEvent):
+    room = settings.ROOMS[ROOM_NAME_TO_IDX[event.room_name]]
+    if event.kind == EVENT_MOTION:
+        is_motion_start = int(event.value) == 1
+        on_motion(room, is_motion_start, event.date)
+    elif event.kind == EVENT_LUMINANCE:
+        luminance_lux = float(event.value)
+        room.luminance_lux = luminance_lux
+        record_sensor_event(room.name, EVENT_LUMINANCE, luminance_lux, event.date)
+    elif event.kind == EVENT_TEMPERATURE:
+        temp_fahrenheit = float(event.value)
+        room.temp_fahrenheit = temp_fahrenheit
+        record_sensor_event(room.name, EVENT_TEMPERATURE, temp_fahrenheit, event.date)
+
+
+def get_sensor_sources() -> list:
+    """
+    :return: a SensorSource for each kind of sensor configured in settings
+    """
+    sources = [ZigbeeUdpSource(sensor_bus.publish,
+                               {addr: room.name for addr, room in PIN_TO_ROOM.items()},
+                               (ZIGBEE_UDP_IP, settings.ZIGBEE_UDP_PORT))]
+    for mac, room_name in settings.BLE_SENSORS.items():
+        sources.append(BleSource(sensor_bus.publish, mac, room_name))
+    if len(settings.GPIO_SENSORS) > 0:
+        sources.append(GpioSource(sensor_bus.publish, settings.GPIO_SENSORS))
+    return sources
+
+
+def start_rooms():
+    """
+    Load room state and schedule room timeouts. Run on the state worker
+    """
+    provision_room_groups({room.name: room.lights for room in settings.ROOMS})
+
+    # This process owns the motion state of the rooms it senses: keep it in memory, persisting it in the
+    # background. Rooms sensed by another process keep reading the database their sensor writes
+    home_snapshot = snapshot()
+    for room in settings.ROOMS:
+        if room.motion_pin != PIN_EXTERNAL_SENSOR:
+            room.load_state(home_snapshot)
 
     # When the motion process starts, set motion enabled
     set_motion_enabled(True)
 
-    while 1:
-        time.sleep(float(min_motion_timeout.seconds) / 2)
-        if is_motion_enabled():
-            disable_inactive_lights()
+    # Rooms lit before a restart still time out
+    start_date = get_local_time()
+    for room in MOTION_ROOMS:
+        schedule_timeout(room, start_date)
+
 
+sources = get_sensor_sources()
+try:
+    submit_to_state_executor(start_rooms)
+    for source in sources:
+        source.start(loop)
+    # Events reach the state worker in the order published, whatever their source
+    loop.create_task(sensor_bus.consume(lambda event: submit_to_state_executor(on_sensor_event, event)))
+    loop.call_later(MOTION_RECHECK_INTERVAL.total_seconds(), on_sweep_timer)
+    loop.run_forever()
 
 except KeyboardInterrupt:
-    #GPIO.cleanup()
-    pass
+    for source in sources:
+        source.stop()
@@ -42,4 +42,13 @@ ROOM_GRAPH = {
     'Living Room': ['Kitchen Hall'],
 }
 
-ZIGBEE_UDP_PORT = 5005
+ZIGBEE_UDP_PORT = 5005  # zigbee.py forwards the readings of Zigbee sensors, per room motion_pin, here
+
+# Other motion sensors, read within motion.py
+BLE_SENSORS = {}  # BLE address -> room name, e.g: {"D4:02:D4:BF:E5:2B": "Bedroom"}
+GPIO_SENSORS = {}  # BCM pin -> room name
+
+# Circadian lighting. If continuous, lit rooms follow the sun's elevation, updated every interval,
+# in between the circadian events. Otherwise lights only change at each event
+CIRCADIAN_CONTINUOUS = False
+CIRCADIAN_UPDATE_INTERVAL_S = 60
@@ -1,11 +1,14 @@
+import bisect
 import datetime
+import threading
 
 import copy
-from astral import SUN_RISING
+from astral import SUN_RISING, SUN_SETTING
 
 from support.hue import COMMAND_OFF
 from support.logger import get_logger
-from support.time_utils import get_local_sunrise, get_local_sunset, LOCAL_TIMEZONE, get_time_at_elevation
+from support.time_utils import get_local_sunrise, get_local_sunset, LOCAL_TIMEZONE, get_time_at_elevation, \
+    get_solar_position
 from support.weather_utils import is_cloudy
 
 LIGHT_DAYTIME_XY = [0.4506, 0.4081]
@@ -15,6 +18,9 @@ LIGHT_LATENIGHT_XY = [0.6185, 0.363]
 
 logger = get_logger("color")
 
+_trigger_dates_by_day = {}  # Local date -> ([trigger datetime per CIRCADIAN_COLORS_ASC], [POSIX timestamp of each])
+_trigger_dates_lock = threading.Lock()
+
 
 class CircadianColor:
     def __init__(self, name: str, color_xy: list, brightness: int, trigger_date_function: callable):
@@ -71,12 +77,12 @@ CIRCADIAN_COLORS_ASC = [
     CircadianColor(name='Early Night',
                    color_xy=[0.58, 0.38],
                    brightness=255,
-                   trigger_date_function=lambda date: date.replace(hour=0, minute=0, second=0, microsecond=0)),  # Midnight of this day
+                   trigger_date_function=lambda date: LOCAL_TIMEZONE.normalize(date.replace(hour=0, minute=0, second=0, microsecond=0))),  # Midnight of this day
 
     CircadianColor(name='Night',
                    color_xy=[0.6185, 0.363],
                    brightness=100,
-                   trigger_date_function=lambda date: date.replace(hour=1, minute=0, second=0, microsecond=0)),
+                   trigger_date_function=lambda date: LOCAL_TIMEZONE.normalize(date.replace(hour=1, minute=0, second=0, microsecond=0))),
 
     CircadianColor(name='Dawn',
                    color_xy=[0.5304, 0.4068],
@@ -110,25 +116,62 @@ CIRCADIAN_COLORS_ASC = [
 ]
 
 
+# Continuous mode: the (elevation in degrees, color name) the curve passes through as the sun rises and as it sets.
+# Elevations match the events' trigger functions, so the curve meets each color when the discrete mode would
+CONTINUOUS_STEP_DEG = 0.5  # Resolution of the precomputed curve
+CONTINUOUS_RISING_POINTS = [(-20, 'Dawn'), (-0.833, 'Sunrise'), (40, 'Day')]  # -0.833: astral's sunrise
+CONTINUOUS_SETTING_POINTS = [(-20, 'Dusk'), (-0.833, 'Sunset'), (20, 'Late Afternoon'), (40, 'Day')]
+
+
+def _build_continuous_curve(points: list) -> list:
+    """
+    :param points: (elevation, color name) pairs, by ascending elevation
+    :return: (xy, brightness) every CONTINUOUS_STEP_DEG from the first point's elevation to the last's,
+    linearly interpolated between the points' colors
+    """
+    colors_by_name = {color.name: color for color in CIRCADIAN_COLORS_ASC}
+    stops = [(elevation,
+              colors_by_name[name].color_xy,
+              colors_by_name[name].brightness or 255)  # A lights-off color is full brightness when lit anyway
+             for elevation, name in points]
+
+    curve = []
+    for step in range(int(round((stops[-1][0] - stops[0][0]) / CONTINUOUS_STEP_DEG)) + 1):
+        elevation = stops[0][0] + step * CONTINUOUS_STEP_DEG
+        stop_idx = max(0, min(len(stops) - 2, bisect.bisect_right([stop[0] for stop in stops], elevation) - 1))
+        (low_elevation, low_xy, low_bri), (high_elevation, high_xy, high_bri) = stops[stop_idx:stop_idx + 2]
+        fraction = min(1.0, (elevation - low_elevation) / (high_elevation - low_elevation))
+
+        curve.append(([round(low + (high - low) * fraction, 4) for low, high in zip(low_xy, high_xy)],
+                      int(round(low_bri + (high_bri - low_bri) * fraction))))
+    return curve
+
+
+_continuous_curves = {SUN_RISING: (CONTINUOUS_RISING_POINTS[0][0], _build_continuous_curve(CONTINUOUS_RISING_POINTS)),
+                      SUN_SETTING: (CONTINUOUS_SETTING_POINTS[0][0], _build_continuous_curve(CONTINUOUS_SETTING_POINTS))}
+
+
 def get_next_circadian_color(date: datetime = None) -> (datetime, CircadianColor):
     if date is None:
         date = datetime.datetime.now(LOCAL_TIMEZONE)
 
-    current_color = get_current_circadian_color(date)
-    current_color_idx = CIRCADIAN_COLORS_ASC.index(current_color)
+    current_color_idx = _get_current_circadian_color_idx(date)
+    current_color = CIRCADIAN_COLORS_ASC[current_color_idx]
+    trigger_dates = _get_trigger_dates(date)[0]
 
     while True:
 
         if current_color_idx == len(CIRCADIAN_COLORS_ASC) - 1:
             current_color_idx = 0
-            next_color = CIRCADIAN_COLORS_ASC[current_color_idx]
-            next_date = next_color.trigger_date_function(date + datetime.timedelta(days=1))  # First event tomorrow
+            tomorrow = _get_local_day(date) + datetime.timedelta(days=1)
+            trigger_dates = _get_trigger_dates(_get_local_midnight(tomorrow))[0]  # First event tomorrow
         else:
             current_color_idx += 1
-            next_color = CIRCADIAN_COLORS_ASC[current_color_idx]
-            next_date = next_color.trigger_date_function(date)
 
-        logger.info("Testing next event (%s) after %s", next_color.name, current_color.name)
+        next_color = CIRCADIAN_COLORS_ASC[current_color_idx]
+        next_date = trigger_dates[current_color_idx]
+
+        logger.debug("Testing next event (%s) after %s", next_color.name, current_color.name)
 
         if next_color.is_valid_for_date(date):
             break
@@ -145,23 +188,84 @@ def get_current_circadian_color(date: datetime = None) -> CircadianColor:
     if date is None:
         date = datetime.datetime.now(LOCAL_TIMEZONE)
 
-    current_color = None
+    current_color = CIRCADIAN_COLORS_ASC[_get_current_circadian_color_idx(date)]
+    logger.debug("Current event at %s is %s", date, current_color.name)
 
-    for color in reversed(CIRCADIAN_COLORS_ASC):
-        if color.trigger_date_function(date) < date and color.is_valid_for_date(date):
-            current_color = color
-            break
+    return current_color
+
+
+def get_continuous_circadian_command(date: datetime = None) -> dict:
+    """
+    :return: the xy and brightness for date along a curve following the sun's elevation through the colors of
+    CIRCADIAN_COLORS_ASC. While the current color is lights-off, or the sun is below the curve, the current
+    color's command, as the discrete mode would send
+    """
+    if date is None:
+        date = datetime.datetime.now(LOCAL_TIMEZONE)
+
+    current_color = get_current_circadian_color(date)
+    if current_color.brightness == 0:
+        return current_color.apply_to_command({})
+
+    elevation_deg, direction = get_solar_position(date)
+    lowest_elevation_deg, curve = _continuous_curves[direction]
+    step = int(round((elevation_deg - lowest_elevation_deg) / CONTINUOUS_STEP_DEG))
+    if step < 0:
+        return current_color.apply_to_command({})
+
+    xy, brightness = curve[min(step, len(curve) - 1)]
+    return {'xy': list(xy), 'bri': brightness}
+
+
+def _get_current_circadian_color_idx(date: datetime) -> int:
+    """
+    :return: the index in CIRCADIAN_COLORS_ASC of the latest valid color triggered before date
+    """
+    timestamps = _get_trigger_dates(date)[1]
+
+    # Index of the latest trigger strictly before date
+    idx = bisect.bisect_left(timestamps, date.timestamp()) - 1
+    while idx >= 0 and not CIRCADIAN_COLORS_ASC[idx].is_valid_for_date(date):
+        idx -= 1
 
     # Note this won't happen so long as first color occurs at midnight
-    if current_color is None:
-        current_color = CIRCADIAN_COLORS_ASC[-1]
+    if idx < 0:
+        idx = len(CIRCADIAN_COLORS_ASC) - 1
 
-    logger.info("Current event at %s is %s since %s",
-                date.strftime('%Y/%m/%d %I:%M:%S %p'),
-                current_color.name,
-                current_color.trigger_date_function(date).strftime('%Y/%m/%d %I:%M:%S %p'))
+    return idx
 
-    return current_color
+
+def _get_trigger_dates(date: datetime) -> (list, list):
+    """
+    :return: the trigger date of each color in CIRCADIAN_COLORS_ASC on date's local day, and the same as
+    POSIX timestamps. Computed once per day, as each trigger may take several astral solves
+    """
+    day = _get_local_day(date)
+
+    with _trigger_dates_lock:
+        trigger_dates = _trigger_dates_by_day.get(day)
+        if trigger_dates is None:
+            # Trigger functions only depend on the day of the date given them. Give them the day's local midnight,
+            # not the date asking, so each day's triggers have the same UTC offsets whichever time of day asks first
+            day_date = _get_local_midnight(day)
+            dates = [color.trigger_date_function(day_date) for color in CIRCADIAN_COLORS_ASC]
+            trigger_dates = (dates, [trigger_date.timestamp() for trigger_date in dates])
+
+            # Keep yesterday, for the moments around midnight, and tomorrow, for the next event
+            for cached_day in list(_trigger_dates_by_day.keys()):
+                if abs((cached_day - day).days) > 1:
+                    del _trigger_dates_by_day[cached_day]
+            _trigger_dates_by_day[day] = trigger_dates
+
+        return trigger_dates
+
+
+def _get_local_day(date: datetime) -> datetime.date:
+    return date.astimezone(LOCAL_TIMEZONE).date() if date.tzinfo is not None else date.date()
+
+
+def _get_local_midnight(day: datetime.date) -> datetime:
+    return LOCAL_TIMEZONE.localize(datetime.datetime.combine(day, datetime.time()))
 
 
 def adjust_command_for_time(command: dict) -> dict:
@@ -174,8 +278,11 @@ def adjust_command_for_time(command: dict) -> dict:
 
     return command
 
-# On startup, print out all circadian event times
-logger.info("Circadian Schedule:")
-now = datetime.datetime.now(LOCAL_TIMEZONE)
-for event in CIRCADIAN_COLORS_ASC:
-    logger.info("%s time %s" % (event.name, event.trigger_date_function(now)))
+
+def log_circadian_schedule(date: datetime = None):
+    if date is None:
+        date = datetime.datetime.now(LOCAL_TIMEZONE)
+
+    logger.info("Circadian Schedule:")
+    for event, trigger_date in zip(CIRCADIAN_COLORS_ASC, _get_trigger_dates(date)[0]):
+        logger.info("%s time %s" % (event.name, trigger_date))
@@ -2,15 +2,32 @@
 This module manages getting and setting inter-process state
 """
 
+import atexit
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
 
-import dateutil.parser
 import os
+import pytz
+
+from support.time_utils import LOCAL_TIMEZONE
 
 DB_FOLDER = '/home/pi/python/'  # TODO: Move to settings
 DB_FILENAME = 'state.db'
-db = None
+DB_BUSY_TIMEOUT_S = 5.0  # How long a connection waits on another process' write lock before raising
+SCHEMA_LOCKED_ATTEMPTS = 3  # Times creating the schema waits out another process' write lock before raising
+KEY_VALUE_MAX_AGE_S = 1.0  # Longest a cached key_value read may miss another process' write
+
+# One connection per thread (sqlite3 connections may not be shared across threads),
+# reset after fork so a child process never reuses its parent's connection
+_local = threading.local()
+_connections = []  # Every open connection in this process, so close() can reach other threads' connections
+_connections_lock = threading.Lock()
+_connections_pid = None
+_generation = 0  # Bumped by close() to invalidate every thread's cached connection
+_schema_created = False  # Whether this process has created or migrated the schema
+_schema_lock = threading.RLock()  # Held while creating the schema. Reentrant, as creating it connects
 
 '''
     Weather
@@ -90,20 +107,14 @@ def set_vacation_mode(enabled: bool):
 
 def set_room_last_motion_date(room_name: str, motion_date: datetime):
 
-    last_motion_date_val = motion_date.isoformat()
+    last_motion_us = _to_epoch_us(motion_date)
 
     db = _db_connect()
 
-    existing_room = db.execute("select id, last_motion_date from room_status where name=?", (room_name,)).fetchone()
-
-    if existing_room is not None and existing_room[0] is not None:
-        existing_id = existing_room[0]
-        last_last_motion_date = existing_room[1]
-        print("Update room '%s' id %d last motion from '%s' to '%s'" % (room_name, existing_id, last_last_motion_date, last_motion_date_val))
-        db.execute("update room_status set last_motion_date=? where id=?", (last_motion_date_val, existing_id))
-    else:
-        print("Insert new room with last motion date %s" % last_motion_date_val)
-        db.execute("insert into room_status (name, last_motion_date) values(?, ?)", (room_name, last_motion_date_val))
+    print("Set room '%s' last motion to '%s'" % (room_name, motion_date))
+    db.execute("insert into room_status (name, last_motion_us) values(?, ?) "
+               "on conflict(name) do update set last_motion_us=excluded.last_motion_us",
+               (room_name, last_motion_us))
     db.commit()
 
 
@@ -112,14 +123,12 @@ def get_room_last_motion_date(room_name: str) -> datetime:
     db = _db_connect()
 
     print("Checking room '%s' last motion" % room_name)
-    last_motion = db.execute("select last_motion_date from room_status where name=?", (room_name,)).fetchone()
+    last_motion = db.execute("select last_motion_us from room_status where name=?", (room_name,)).fetchone()
 
     if last_motion is not None and last_motion[0] is not None:
-        print("Room '%s' last motion '%s'" % (room_name, last_motion[0]))
-        try:
-            return dateutil.parser.parse(last_motion[0])
-        except:
-            pass
+        last_motion_date = _from_epoch_us(last_motion[0])
+        print("Room '%s' last motion '%s'" % (room_name, last_motion_date))
+        return last_motion_date
 
     return None
 
@@ -134,16 +143,10 @@ def set_room_occupied(room_name: str, occupied: bool):
 
     db = _db_connect()
 
-    existing_room = db.execute("select id, occupied from room_status where name=?", (room_name,)).fetchone()
-
-    if existing_room is not None and existing_room[0] is not None:
-        existing_id = existing_room[0]
-        was_occupied = existing_room[1]
-        print("Update room '%s' occupied from '%s' to '%s'" % (room_name, was_occupied, occupied_val))
-        db.execute("update room_status set occupied=? where id=?", (occupied_val, existing_id))
-    else:
-        print("Insert new room with occupied %s" % occupied_val)
-        db.execute("insert into room_status (name, occupied) values(?, ?)", (room_name, occupied_val))
+    print("Set room '%s' occupied to '%s'" % (room_name, occupied_val))
+    db.execute("insert into room_status (name, occupied) values(?, ?) "
+               "on conflict(name) do update set occupied=excluded.occupied",
+               (room_name, occupied_val))
     db.commit()
 
 
@@ -159,28 +162,397 @@ def get_room_occupied(room_name: str) -> bool:
     return False
 
 
+'''
+    Write-behind room status
+    For a process that keeps room status in memory, and only needs state.db to share it with other processes
+'''
+WRITE_BEHIND_INTERVAL_S = 1.0  # Queued room status is written within this period
+
+_pending_room_statuses = {}  # Room name -> column -> value. Later writes to a column replace earlier ones
+_pending_room_statuses_lock = threading.Lock()
+
+
+def queue_room_last_motion_date(room_name: str, motion_date: datetime):
+    _queue_room_status(room_name, 'last_motion_us', _to_epoch_us(motion_date))
+
+
+def queue_room_occupied(room_name: str, occupied: bool):
+    _queue_room_status(room_name, 'occupied', 1 if occupied else 0)
+
+
+def flush_room_statuses():
+    """
+    Write all queued room status in a single transaction
+    """
+    with _pending_room_statuses_lock:
+        if len(_pending_room_statuses) == 0:
+            return
+        room_statuses = dict(_pending_room_statuses)
+        _pending_room_statuses.clear()
+
+    db = _db_connect()
+    with db:
+        for room_name, columns in room_statuses.items():
+            # Column names only ever come from the queue_ functions above
+            names = sorted(columns.keys())
+            db.execute("insert into room_status (name, %s) values(?, %s) on conflict(name) do update set %s" %
+                       (", ".join(names),
+                        ", ".join("?" * len(names)),
+                        ", ".join("%s=excluded.%s" % (name, name) for name in names)),
+                       [room_name] + [columns[name] for name in names])
+
+
+def _queue_room_status(room_name: str, column: str, value):
+    with _pending_room_statuses_lock:
+        _pending_room_statuses.setdefault(room_name, {})[column] = value
+    _start_writer()
+
+
+'''
+    Sensor history
+'''
+EVENT_MOTION = 'motion'  # Value 1 for motion start, 0 for motion stop
+EVENT_LUMINANCE = 'luminance'  # Value in lux
+EVENT_TEMPERATURE = 'temp'  # Value in fahrenheit
+
+HISTORY_FLUSH_INTERVAL_S = 10  # Recorded events are written in one transaction per interval
+HISTORY_COMPACT_INTERVAL_S = 60 * 60
+HISTORY_RAW_RETENTION = timedelta(days=7)  # After this, luminance and temperature are kept as hourly averages
+HISTORY_RETENTION = timedelta(days=365)  # After this, events are deleted
+HISTORY_BUCKET = timedelta(hours=1)
+
+_pending_sensor_events = []
+_pending_sensor_events_lock = threading.Lock()
+
+
+def record_sensor_event(room_name: str, kind: str, value: float, event_date: datetime = None):
+    """
+    Queue a sensor reading for the history table. It is written by a background thread within
+    HISTORY_FLUSH_INTERVAL_S, or by flush_sensor_events()
+
+    :param kind: one of EVENT_MOTION, EVENT_LUMINANCE or EVENT_TEMPERATURE
+    :param event_date: when the reading was taken. If None, now
+    """
+    if event_date is None:
+        event_date = datetime.now(pytz.utc)
+
+    with _pending_sensor_events_lock:
+        _pending_sensor_events.append((room_name, kind, value, _to_epoch_us(event_date)))
+    _start_writer()
+
+
+def flush_sensor_events():
+    """
+    Write all queued sensor readings in a single transaction
+    """
+    with _pending_sensor_events_lock:
+        if len(_pending_sensor_events) == 0:
+            return
+        events = list(_pending_sensor_events)
+        del _pending_sensor_events[:]
+
+    db = _db_connect()
+    with db:
+        db.executemany("insert into sensor_event (room_name, kind, value, event_us) values(?, ?, ?, ?)", events)
+
+
+def get_sensor_events(room_name: str, start_date: datetime, end_date: datetime = None, kind: str = None) -> list:
+    """
+    :param end_date: exclusive end of the range. If None, now
+    :param kind: only return events of this kind. If None, all kinds
+    :return: (event date, kind, value) tuples in ascending date order. Readings older than HISTORY_RAW_RETENTION
+    are hourly averages dated at the start of their hour
+    """
+    flush_sensor_events()
+
+    end_us = _to_epoch_us(end_date) if end_date is not None else _to_epoch_us(datetime.now(pytz.utc)) + 1
+    query = "select event_us, kind, value from sensor_event where room_name=? and event_us >= ? and event_us < ?"
+    args = [room_name, _to_epoch_us(start_date), end_us]
+    if kind is not None:
+        query += " and kind=?"
+        args.append(kind)
+    query += " order by event_us"
+
+    db = _db_connect()
+    return [(_from_epoch_us(row[0]), row[1], row[2]) for row in db.execute(query, args)]
+
+
+def compact_sensor_events(as_of_date: datetime = None):
+    """
+    Average luminance and temperature readings older than HISTORY_RAW_RETENTION into one row per room, kind and
+    HISTORY_BUCKET, and delete all events older than HISTORY_RETENTION. Motion events are never averaged.
+    """
+    if as_of_date is None:
+        as_of_date = datetime.now(pytz.utc)
+
+    bucket_us = HISTORY_BUCKET // _MICROSECOND
+    # Only whole buckets, so a bucket is never averaged in two halves
+    raw_cutoff_us = (_to_epoch_us(as_of_date - HISTORY_RAW_RETENTION) // bucket_us) * bucket_us
+    cutoff_us = _to_epoch_us(as_of_date - HISTORY_RETENTION)
+
+    db = _db_connect()
+    with db:
+        db.execute(r"begin immediate")
+        db.execute("insert into sensor_event (room_name, kind, value, event_us, downsampled) "
+                   "select room_name, kind, avg(value), (event_us / ?) * ?, 1 from sensor_event "
+                   "where kind != ? and downsampled = 0 and event_us < ? "
+                   "group by room_name, kind, event_us / ?",
+                   (bucket_us, bucket_us, EVENT_MOTION, raw_cutoff_us, bucket_us))
+        db.execute("delete from sensor_event where kind != ? and downsampled = 0 and event_us < ?",
+                   (EVENT_MOTION, raw_cutoff_us))
+        db.execute("delete from sensor_event where event_us < ?", (cutoff_us,))
+
+
+'''
+    Hue bridge command budget
+    Shared by every process commanding the bridge, as its limits are for all of them together
+'''
+BRIDGE_URGENT_HOLD_S = 2.0  # After an urgent command, deferrable commands wait this long for more of them
+
+
+def take_bridge_token(kind: str, rate_per_s: float, urgent: bool = False, deferrable: bool = False) -> float:
+    """
+    Take a token for one bridge command from the bucket every process shares for the kind of command.
+    The bucket refills at rate_per_s, holding up to a second's worth
+
+    :param kind: the kind of command, e.g: 'lights' or 'groups'
+    :param urgent: whether someone waits on the command. Holds back deferrable commands for BRIDGE_URGENT_HOLD_S
+    :param deferrable: whether the command waits while urgent commands are being sent
+    :return: 0 if a token was taken. Otherwise the seconds to wait before trying again
+    """
+    now = time.time()
+
+    db = _db_connect()
+    with db:
+        db.execute(r"begin immediate")
+        row = db.execute("select tokens, updated, urgent_until from bridge_budget where kind=?", (kind,)).fetchone()
+        if row is None:
+            tokens = rate_per_s
+            urgent_until = 0.0
+        else:
+            # Never refill for time the clock went back
+            tokens = min(rate_per_s, row[0] + max(0.0, now - row[1]) * rate_per_s)
+            urgent_until = row[2]
+
+        if urgent:
+            urgent_until = now + BRIDGE_URGENT_HOLD_S
+
+        # Urgent commands of any kind hold back deferrable ones, as every command loads the same Zigbee network.
+        # Never for longer than an urgent command asks, should the clock have gone back
+        held_until = db.execute("select max(urgent_until) from bridge_budget").fetchone()[0] or 0.0
+        held_until = min(max(held_until, urgent_until), now + BRIDGE_URGENT_HOLD_S)
+
+        if deferrable and now < held_until:
+            wait_s = held_until - now
+        elif tokens < 1:
+            wait_s = (1 - tokens) / rate_per_s
+        else:
+            tokens -= 1
+            wait_s = 0.0
+
+        db.execute("insert into bridge_budget (kind, tokens, updated, urgent_until) values(?, ?, ?, ?) "
+                   "on conflict(kind) do update set tokens=excluded.tokens, updated=excluded.updated, "
+                   "urgent_until=excluded.urgent_until",
+                   (kind, tokens, now, urgent_until))
+    return wait_s
+
+
+'''
+    Snapshot
+'''
+
+
+class HomeSnapshot:
+    """
+    All modes, the cloud cover and every room's status, as read in a single transaction
+    """
+
+    def __init__(self, key_values: dict, room_statuses: dict):
+        """
+        :param key_values: the key_value table as key -> value
+        :param room_statuses: the room_status table as room name -> (occupied, last_motion_us)
+        """
+        self.key_values = key_values
+        self.room_statuses = room_statuses
+
+    def is_motion_enabled(self) -> bool:
+        return _to_bool(self.key_values.get(KEY_MOTION_MODE))
+
+    def is_guest_mode(self) -> bool:
+        return _to_bool(self.key_values.get(KEY_GUEST_MODE))
+
+    def is_party_mode(self) -> bool:
+        return _to_bool(self.key_values.get(KEY_PARTY_MODE))
+
+    def is_vacation_mode(self) -> bool:
+        return _to_bool(self.key_values.get(KEY_VACATION_MODE))
+
+    def get_cloud_cover(self) -> float:
+        return float(self.key_values.get(KEY_CLOUD_COVER, 0))
+
+    def get_room_occupied(self, room_name: str) -> bool:
+        room_status = self.room_statuses.get(room_name)
+        return room_status is not None and room_status[0] == 1
+
+    def get_room_last_motion_date(self, room_name: str) -> datetime:
+        room_status = self.room_statuses.get(room_name)
+        if room_status is None or room_status[1] is None:
+            return None
+        return _from_epoch_us(room_status[1])
+
+
+def snapshot() -> HomeSnapshot:
+    db = _db_connect()
+
+    with db:
+        # A deferred transaction, so both selects see the same database state
+        db.execute(r"begin")
+        data_version = db.execute(r"PRAGMA data_version").fetchone()[0]
+        key_values = {}
+        for row in db.execute("select key, value from key_value"):
+            if row[1] is not None:
+                key_values[row[0]] = row[1]
+        room_statuses = {}
+        for row in db.execute("select name, occupied, last_motion_us from room_status"):
+            room_statuses[row[0]] = (row[1], row[2])
+
+    # We just paid for a full key_value read, refresh this thread's cache with it
+    _local.key_values = dict(key_values)
+    _local.key_values_version = data_version
+    _local.key_values_checked = time.monotonic()
+
+    return HomeSnapshot(key_values, room_statuses)
+
+
 '''
     Private API
 '''
 
 
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+
+def _start_writer():
+    """
+    Start the thread writing queued room status and sensor events, if not running
+    """
+    global _writer_thread
+
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name='env-writer', daemon=True)
+            _writer_thread.start()
+
+
+def _writer_loop():
+    history_flushed = time.monotonic()
+    history_compacted = None
+
+    while True:
+        time.sleep(WRITE_BEHIND_INTERVAL_S)
+        try:
+            flush_room_statuses()
+
+            now = time.monotonic()
+            if now - history_flushed >= HISTORY_FLUSH_INTERVAL_S:
+                flush_sensor_events()
+                history_flushed = now
+
+            if history_compacted is None or now - history_compacted >= HISTORY_COMPACT_INTERVAL_S:
+                compact_sensor_events()
+                history_compacted = now
+        except sqlite3.Error as e:
+            print("Failed to write queued state: %s" % e)
+
+
+def _to_bool(value) -> bool:
+    return not (value is None or value == '0')
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _to_epoch_us(date: datetime) -> int:
+    """
+    :return: microseconds since the epoch. A naive date is taken to be local time
+    """
+    if date.tzinfo is None:
+        date = LOCAL_TIMEZONE.localize(date)
+    return (date - _EPOCH) // _MICROSECOND
+
+
+def _from_epoch_us(epoch_us: int) -> datetime:
+    """
+    :return: the local time epoch_us microseconds after the epoch
+    """
+    return (_EPOCH + timedelta(microseconds=epoch_us)).astimezone(LOCAL_TIMEZONE)
+
+
+def _migrate_last_motion_dates(db):
+    """
+    Rebuild room_status with last motion as integer epoch microseconds instead of ISO text,
+    which had to be parsed with dateutil on every read
+    """
+    import dateutil.parser  # Only needed to read the old format
+
+    rows = []
+    for row in db.execute(r"select id, name, occupied, last_motion_date from room_status"):
+        last_motion_us = None
+        if row[3] is not None:
+            try:
+                last_motion_us = _to_epoch_us(dateutil.parser.parse(row[3]))
+            except:
+                pass  # Unreadable dates were treated as no motion anyway
+        rows.append((row[0], row[1], row[2], last_motion_us))
+
+    db.execute(r"alter table room_status rename to room_status_v2")
+    db.execute(r"create table room_status ("
+               r"id integer primary key AUTOINCREMENT,"
+               r"name text NOT NULL,"
+               r"occupied int DEFAULT 0,"
+               r"last_motion_us integer"
+               r")")
+    db.executemany(r"insert into room_status (id, name, occupied, last_motion_us) values(?, ?, ?, ?)", rows)
+    db.execute(r"drop table room_status_v2")  # Also drops its room_status_name index
+    db.execute(r"create unique index room_status_name on room_status (name)")
+
+
 def _get_bool_value(key: str) -> bool:
-    value = _get_value(key)
-    print("Bool key '%s' has value '%s'" % (key, not (value is None or value == '0')))
-    if value is None or value == '0':
-        return False
-    return True
+    value = _to_bool(_get_value(key))
+    print("Bool key '%s' has value '%s'" % (key, value))
+    return value
 
 
 def _get_value(key: str):
+    return _get_key_values().get(key)
+
+
+def _get_key_values() -> dict:
+    """
+    :return: this thread's cache of the key_value table, reloaded only when another connection
+    has committed since it was loaded. The check itself is skipped for KEY_VALUE_MAX_AGE_S after the last one.
+    """
+    now = time.monotonic()
     db = _db_connect()
+    key_values = getattr(_local, 'key_values', None)
 
-    value = db.execute("select value from key_value where key=?", (key,)).fetchone()
+    if key_values is not None and now - _local.key_values_checked < KEY_VALUE_MAX_AGE_S:
+        return key_values
 
-    if value is not None and value[0] is not None:
-        print("Get %s . Result '%s'" % (key, value[0]))
-        return value[0]
-    return None
+    # data_version changes whenever any other connection, in any process, commits to the database
+    data_version = db.execute(r"PRAGMA data_version").fetchone()[0]
+    if key_values is None or data_version != _local.key_values_version:
+        key_values = {}
+        for row in db.execute("select key, value from key_value"):
+            if row[1] is not None:
+                key_values[row[0]] = row[1]
+        _local.key_values = key_values
+        _local.key_values_version = data_version
+
+    _local.key_values_checked = now
+    return key_values
 
 
 def _set_bool_value(key: str, value: bool):
@@ -190,15 +562,20 @@ def _set_bool_value(key: str, value: bool):
 def _set_value(key: str, value):
     db = _db_connect()
 
-    existing_value = _get_value(key)
-    if existing_value is not None:
-        print("Update key '%s' value from '%s' to '%s'" % (key, existing_value, value))
-        db.execute("update key_value set value=? where key=?", (value, key))
-    else:
-        print("Insert %s -> %s" % (key, value))
-        db.execute("insert into key_value (key, value) values(?, ?)", (key, value))
+    print("Set %s -> %s" % (key, value))
+    db.execute("insert into key_value (key, value) values(?, ?) "
+               "on conflict(key) do update set value=excluded.value",
+               (key, value))
     db.commit()
 
+    # Our own commits don't change our connection's data_version, so write through to the cache
+    key_values = getattr(_local, 'key_values', None)
+    if key_values is not None:
+        if value is None:
+            key_values.pop(key, None)
+        else:
+            key_values[key] = str(value)  # As stored by the text column
+
 
 def _get_schema_version(db):
     # user_version is per database value, its used here
@@ -206,15 +583,20 @@ def _get_schema_version(db):
     return db.execute(r"PRAGMA user_version").fetchone()[0]
 
 
-def _create_schema(start_fresh=False):
+def _create_schema(start_fresh=False, attempt=1):
     try:
         if start_fresh:
+            # Never rename the file out from under an open connection
+            close()
+
             db_path = os.path.join(DB_FOLDER, DB_FILENAME)
             if os.path.exists(db_path):
                 # Preserve one backup, for evidence!
                 os.rename(db_path, db_path + ".old")
 
         with _db_connect() as db:
+            # Migrate in one write transaction, so processes starting together don't both apply a step
+            db.execute(r"begin immediate")
             # fall through each block updating the user_version each time
             # so that schema changes can be correctly applied
             version = _get_schema_version(db)
@@ -231,23 +613,148 @@ def _create_schema(start_fresh=False):
                            r"value text"
                            r")")
                 db.execute(r"PRAGMA user_version=1")
+                version = 1
+            if version == 1:
+                # Setters used to SELECT then INSERT, so concurrent writers could duplicate a name or key.
+                # Setters always updated the first row found, so keep the oldest
+                db.execute(r"delete from room_status where id not in "
+                           r"(select min(id) from room_status group by name)")
+                db.execute(r"delete from key_value where id not in "
+                           r"(select min(id) from key_value group by key)")
+                # Unique indexes back the setters' 'on conflict' upserts, and index the lookups
+                db.execute(r"create unique index room_status_name on room_status (name)")
+                db.execute(r"create unique index key_value_key on key_value (key)")
+                db.execute(r"PRAGMA user_version=2")
+                version = 2
+            if version == 2:
+                _migrate_last_motion_dates(db)
+                db.execute(r"PRAGMA user_version=3")
+                version = 3
+            if version == 3:
+                db.execute(r"create table sensor_event ("
+                           r"id integer primary key AUTOINCREMENT,"
+                           r"room_name text NOT NULL,"
+                           r"kind text NOT NULL,"
+                           r"value real,"
+                           r"event_us integer NOT NULL,"
+                           r"downsampled int DEFAULT 0"
+                           r")")
+                db.execute(r"create index sensor_event_room_date on sensor_event (room_name, event_us)")
+                db.execute(r"PRAGMA user_version=4")
+                version = 4
+            if version == 4:
+                db.execute(r"create table bridge_budget ("
+                           r"kind text primary key,"
+                           r"tokens real NOT NULL,"
+                           r"updated real NOT NULL,"
+                           r"urgent_until real NOT NULL"
+                           r")")
+                db.execute(r"PRAGMA user_version=5")
+                version = 5
+    except sqlite3.OperationalError as e:
+        if not _is_locked_error(e):
+            return _recreate_schema(start_fresh)
+        # Another process held the write lock beyond DB_BUSY_TIMEOUT_S, e.g: migrating too.
+        # The database is fine: wait again, and never start fresh over it
+        if attempt >= SCHEMA_LOCKED_ATTEMPTS:
+            raise
+        return _create_schema(start_fresh, attempt + 1)
     except:
-        #logger.exception("Failed in creating database schema while {}starting fresh".format("" if start_fresh else "not "))
-        if not start_fresh:
-            return _create_schema(start_fresh=True)
-        return False
+        return _recreate_schema(start_fresh)
     return True
 
 
+def _recreate_schema(start_fresh):
+    #logger.exception("Failed in creating database schema while {}starting fresh".format("" if start_fresh else "not "))
+    if not start_fresh:
+        return _create_schema(start_fresh=True)
+    return False
+
+
+def _is_locked_error(e: sqlite3.OperationalError) -> bool:
+    """
+    :return: whether e is another connection's lock, rather than a damaged database
+    """
+    message = str(e)
+    return 'locked' in message or 'busy' in message
+
+
+def close():
+    """
+    Close every connection this process opened. Threads transparently re-open on next use.
+    """
+    global _connections_pid, _generation
+
+    flush_room_statuses()
+    flush_sensor_events()
+
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        del _connections[:]
+        _connections_pid = None
+        _generation += 1
+
+
 def _db_connect():
-    if not os.path.exists(DB_FOLDER):
-        os.makedirs(DB_FOLDER)
+    """
+    :return: this thread's pooled connection, opened on first use
+    """
+    global _connections_pid
+
+    pool_key = (os.getpid(), _generation)
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pool_key == pool_key:
+        _ensure_schema()  # If creating it failed, e.g: on another process' lock, try again
+        return _local.conn
+
+    with _connections_lock:
+        if _connections_pid != pool_key[0]:
+            # First connection in this process (or we were forked): forget the parent's connections
+            # without closing them, as they belong to the parent
+            del _connections[:]
+            _connections_pid = pool_key[0]
+            if not os.path.exists(DB_FOLDER):
+                os.makedirs(DB_FOLDER)
+
+        db_path = os.path.join(DB_FOLDER, DB_FILENAME)
+        # Each connection is only used by the thread that opened it, but close() may run on another thread
+        conn = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT_S, detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers proceed while another process holds the write lock
+        conn.execute(r"PRAGMA journal_mode=WAL")
+        conn.execute(r"PRAGMA synchronous=NORMAL")
+        _connections.append(conn)
+
+    _local.conn = conn
+    _local.pool_key = pool_key
+    _local.key_values = None  # data_version is per connection, so the cache can't outlive its connection
+
+    _ensure_schema()
+    # Starting the schema fresh closes every connection, conn included, and opens this thread another
+    return _local.conn
+
+
+def _ensure_schema():
+    """
+    Create or migrate the database on first use in this process, rather than on import
+    """
+    global _schema_created
+
+    if _schema_created:
+        return
+
+    # Other threads wait for the schema. This thread's own connections, made while creating it, don't
+    with _schema_lock:
+        if _schema_created or getattr(_local, 'creating_schema', False):
+            return
+        _local.creating_schema = True
+        try:
+            _create_schema()
+            _schema_created = True
+        finally:
+            _local.creating_schema = False
 
-    db_path = os.path.join(DB_FOLDER, DB_FILENAME)
-    conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
-    conn.row_factory = sqlite3.Row
-    return conn
+atexit.register(close)
 
-# Create the database on startup
-_create_schema()
-print("Create schema!")
@@ -1,12 +1,568 @@
+import atexit
+import concurrent.futures
+import os
+import threading
+import time
+
 from phue import Bridge
 
-hue = Bridge('192.168.7.23')
-hue.connect()
+from support.env import take_bridge_token
+from support.hue_client import HueClient
+from support.logger import get_logger
+
+logger = get_logger("hue")
+
+# Override with e.g: HUE_BRIDGE_IP=127.0.0.1:8000 to use hue_emulator.py
+BRIDGE_IP = os.environ.get('HUE_BRIDGE_IP', '192.168.7.23')
 
 COMMAND_FULL_ON = {'on': True, 'bri': 254}
 COMMAND_OFF = {'on': False}
 
+GROUP_ALL_LIGHTS = 0  # The bridge's built-in group of every light
+GROUP_NAME_PREFIX = 'HoS '  # Distinguishes our room groups from those made by the Hue app
+
+# Command priorities. Lower is sent first
+PRIORITY_MOTION = 0  # Someone is waiting on these lights
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2  # Circadian transitions and animations
+
+# The bridge's recommended command budgets, for all processes together. Beyond these it queues or drops commands
+LIGHT_COMMANDS_PER_S = 10
+GROUP_COMMANDS_PER_S = 1
+DRAIN_ON_EXIT_TIMEOUT_S = 10.0  # How long exit waits for queued commands to be sent
+
+# State attributes compared against the light state cache to skip sending values lights already have
+DIFFED_ATTRIBUTES = ('on', 'bri', 'xy', 'ct', 'hue', 'sat')
+XY_TOLERANCE = 0.0001  # The bridge stores xy to 4 decimal places
+
+LIGHT_STATE_TTL_S = 5.0  # Longest the light state cache may miss a change made by another process or the Hue app
+LIGHT_STATE_MAX_AGE_S = 60.0  # Past this, e.g: while the bridge fails refreshes, the cache is too old to trust
+
+_light_states = {}  # Light id -> Hue light state dict, e.g: {'on': True, 'bri': 254, 'xy': [0.4506, 0.4081], ...}
+_light_states_refreshed = None  # time.monotonic() of the last bulk fetch
+_light_states_refreshing = False  # Whether a background fetch is in flight
+_light_states_modified = {}  # Light id -> time.monotonic() a command's result last changed its cached state
+_light_states_lock = threading.Lock()
+
+_room_group_ids = {}  # Room name -> group id, or None if the room can't have a group. Set by provision_room_groups
+
+# Connected on first use, so importing this module never waits on the bridge
+_bridge = None
+_client = None
+_bridge_lock = threading.Lock()
+
+
+class CommandScheduler:
+    """
+    Sends light and group commands from a background thread within the bridge's per-second budgets,
+    which every process shares through state.db. A command to a target with a command still queued is merged into it,
+    later values winning, so only the latest state is sent. Queued commands are sent in priority, then submission,
+    order. Across processes, bulk commands wait while motion commands are being sent.
+    """
+
+    def __init__(self, light_commands_per_s: float = LIGHT_COMMANDS_PER_S,
+                 group_commands_per_s: float = GROUP_COMMANDS_PER_S):
+        self._rates = {'lights': light_commands_per_s, 'groups': group_commands_per_s}
+        self._tokens = dict(self._rates)  # Allow up to a second's worth of commands in a burst
+        self._tokens_updated = time.monotonic()
+        # Kind -> priority -> time.monotonic() until which the shared budget holds back commands of that priority
+        self._held_until = {kind: [0.0] * (PRIORITY_BULK + 1) for kind in self._rates}
+
+        self._pending = {}  # (kind, id) -> [command, priority, sequence, lights]
+        self._sequence = 0
+        self._in_flight = set()  # Targets of commands sent but not yet answered
+        self._condition = threading.Condition()
+        self._thread = None
+
+        self.sent_count = 0
+        self.suppressed_count = 0  # Commands not sent as the lights were already in the commanded state
+        self.suppressed_attribute_count = 0  # Attributes removed from sent commands for the same reason
+
+    def submit(self, kind: str, target_id: int, command: dict, priority: int = PRIORITY_NORMAL, lights: list = None):
+        """
+        :param kind: 'lights' or 'groups'
+        :param lights: for a group, the lights in it
+        """
+        with self._condition:
+            key = (kind, target_id)
+            pending = self._pending.get(key)
+            if pending is not None:
+                pending[0].update(command)
+                pending[1] = min(pending[1], priority)
+            else:
+                self._sequence += 1
+                self._pending[key] = [dict(command), priority, self._sequence, lights]
+
+            if kind == 'groups':
+                # A queued light command can't be allowed to land after, and undo, a later group command
+                for light in (lights or []):
+                    pending_light = self._pending.get(('lights', light))
+                    if pending_light is not None:
+                        for attribute in command:
+                            pending_light[0].pop(attribute, None)
+                        if len(pending_light[0]) == 0 or list(pending_light[0].keys()) == ['transitiontime']:
+                            del self._pending[('lights', light)]
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='hue-commands', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def drain(self, timeout_s: float = None) -> bool:
+        """
+        Wait for all queued commands to be sent
+        :return: whether the queue emptied before the timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self._pending) == 0 and len(self._in_flight) == 0,
+                                            timeout_s)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                key, pending = self._take_next()
+                self._in_flight.add(key)
+
+            # Diff as late as possible, against state that includes every earlier command's result
+            command = pending[0]
+            try:
+                command = diff_command(command, pending[3] if key[0] == 'groups' else [key[1]])
+            except Exception:
+                logger.exception("Failed to diff %s against light state. Sending in full", command)
+
+            suppressed_attribute_count = len(set(pending[0]) - set(command) - {'transitiontime'})
+            with self._condition:
+                if len(command) == 0:
+                    self.suppressed_attribute_count += suppressed_attribute_count
+                    self.suppressed_count += 1
+                    # Nothing was sent, so refund its budget
+                    self._tokens[key[0]] = min(self._rates[key[0]], self._tokens[key[0]] + 1)
+                    self._in_flight.discard(key)
+                    self._condition.notify_all()
+                    continue
+
+            wait_s = self._take_shared_token(key[0], pending[1])
+            with self._condition:
+                if wait_s > 0:
+                    self._requeue(key, pending, wait_s)
+                    continue
+                self.suppressed_attribute_count += suppressed_attribute_count
+                self.sent_count += 1
+
+            # Don't wait for the response: the client bounds how many commands are in flight
+            path = '/%s/%d/%s' % (key[0], key[1], 'action' if key[0] == 'groups' else 'state')
+            try:
+                future = get_client().submit('PUT', path, command)
+            except Exception as e:  # The bridge is unreachable
+                future = concurrent.futures.Future()
+                future.set_exception(e)
+            future.add_done_callback(lambda future, key=key, pending=pending: self._on_sent(key, pending, future))
+
+    def _on_sent(self, key: tuple, pending: list, future):
+        command, priority, sequence, lights = pending
+        try:
+            _apply_result(future.result(), group_lights=lights)
+        except Exception:
+            logger.exception("Failed to send %s to %s %d", command, key[0], key[1])
+
+        with self._condition:
+            self._in_flight.discard(key)
+            self._condition.notify_all()
+
+    def _take_shared_token(self, kind: str, priority: int) -> float:
+        """
+        :return: 0 if the budget every process shares allows sending a command, otherwise the seconds to wait
+        """
+        try:
+            return take_bridge_token(kind, self._rates[kind], urgent=priority == PRIORITY_MOTION,
+                                     deferrable=priority >= PRIORITY_BULK)
+        except Exception as e:  # e.g: state.db is locked. Fall back to this process' budget alone
+            logger.error("Failed to take a shared bridge %s token: %s", kind, e)
+            return 0.0
+
+    def _requeue(self, key: tuple, pending: list, wait_s: float):
+        """
+        Put back a command the shared budget held back, and hold back its kind of command, at its priority and
+        lower, for wait_s. Hold the condition.
+        """
+        kind = key[0]
+        self._tokens[kind] = min(self._rates[kind], self._tokens[kind] + 1)  # Not spent
+        held_until = self._held_until[kind]
+        for priority in range(pending[1], len(held_until)):
+            held_until[priority] = max(held_until[priority], time.monotonic() + wait_s)
+
+        command = pending[0]
+        newer = self._pending.get(key)
+        if newer is not None:
+            command.update(newer[0])
+            pending[1] = min(pending[1], newer[1])
+        if kind == 'lights':
+            # As in submit(): a group command queued since must not be undone by this older light command
+            for other_key, other in self._pending.items():
+                if other_key[0] == 'groups' and other[2] > pending[2] and key[1] in (other[3] or []):
+                    for attribute in other[0]:
+                        command.pop(attribute, None)
+
+        if len(command) > 0 and list(command.keys()) != ['transitiontime']:
+            self._pending[key] = pending
+        else:
+            self._pending.pop(key, None)
+        self._in_flight.discard(key)
+        self._condition.notify_all()
+
+    def _take_next(self):
+        """
+        Wait for a queued command whose budget allows sending, and remove it from the queue. Hold the condition.
+        """
+        while True:
+            self._refill_tokens()
+
+            now = time.monotonic()
+            ready = []
+            for key, pending in self._pending.items():
+                # A target's commands are sent one at a time, so they can't arrive out of order
+                if self._tokens[key[0]] >= 1 and key not in self._in_flight \
+                        and self._held_until[key[0]][pending[1]] <= now \
+                        and not self._waits_on_group(key, pending):
+                    ready.append((pending[1], pending[2], key))
+
+            if len(ready) > 0:
+                key = min(ready)[2]
+                self._tokens[key[0]] -= 1
+                return key, self._pending.pop(key)
+
+            if len(self._pending) == 0:
+                self._condition.wait()
+            else:
+                # Sleep until the next token, or a new command arrives
+                self._condition.wait(min(1.0 / rate for rate in self._rates.values()))
+
+    def _waits_on_group(self, key: tuple, pending: list) -> bool:
+        """
+        :return: whether the given light command must wait for an earlier queued group command containing the light
+        """
+        if key[0] != 'lights':
+            return False
+        for other_key, other in self._pending.items():
+            if other_key[0] == 'groups' and other[2] < pending[2] and key[1] in (other[3] or []):
+                return True
+        return False
+
+    def _refill_tokens(self):
+        now = time.monotonic()
+        elapsed = now - self._tokens_updated
+        self._tokens_updated = now
+        for kind, rate in self._rates.items():
+            self._tokens[kind] = min(rate, self._tokens[kind] + elapsed * rate)
+
+
+def get_bridge() -> Bridge:
+    """
+    :return: the phue Bridge, connecting on first call. Used for registration and group provisioning
+    """
+    global _bridge
+
+    with _bridge_lock:
+        if _bridge is None:
+            bridge = Bridge(BRIDGE_IP)
+            bridge.connect()
+            _bridge = bridge
+        return _bridge
+
+
+def get_client() -> HueClient:
+    """
+    :return: the client light state reads and commands use, over kept-alive connections
+    """
+    global _client
+
+    bridge = get_bridge()
+    with _bridge_lock:
+        if _client is None:
+            _client = HueClient(bridge.ip, bridge.username)
+        return _client
+
+
+def diff_command(command: dict, lights: list) -> dict:
+    """
+    :param lights: the lights the command is sent to
+    :return: the command without the attributes every light already has, according to the light state cache,
+    and without attributes that can't be set as every light is, and will stay, off. Empty if nothing would change.
+    Never waits on the bridge
+    """
+    states = [get_cached_light_state(light) for light in lights]
+    if len(states) == 0 or any(state is None or len(state) == 0 for state in states):
+        return dict(command)  # A cold or too old cache, or unknown lights: send everything
+
+    turning_on = command.get('on') is True
+    diff = {}
+    for attribute, value in command.items():
+        if attribute == 'transitiontime':
+            continue
+        if attribute not in DIFFED_ATTRIBUTES:
+            diff[attribute] = value  # e.g: 'alert' is an action, not a state
+            continue
+
+        for state in states:
+            if attribute != 'on' and not state.get('on', False) and not turning_on:
+                continue  # Off lights reject other attributes
+            if not _state_has_value(state, attribute, value):
+                diff[attribute] = value
+                break
+
+    if len(diff) > 0 and 'transitiontime' in command:
+        diff['transitiontime'] = command['transitiontime']
+    return diff
+
+
+def get_command_stats() -> dict:
+    """
+    :return: counts of commands sent, and commands and attributes suppressed by diff_command, by this process
+    """
+    return {'sent': commands.sent_count,
+            'suppressed': commands.suppressed_count,
+            'suppressed_attributes': commands.suppressed_attribute_count}
+
+
+commands = CommandScheduler()
+atexit.register(lambda: commands.drain(DRAIN_ON_EXIT_TIMEOUT_S))
+
+
+def command_all_lights(command: dict, priority: int = PRIORITY_NORMAL):
+    set_group(GROUP_ALL_LIGHTS, get_light_ids(), command, priority)
+
+
+def set_room_lights(room_name: str, lights: list, command: dict, priority: int = PRIORITY_NORMAL):
+    """
+    Queue a command to all of a room's lights. Uses the room's bridge group, so the bridge
+    changes all lights together from a single request.
+    """
+    group_id = get_room_group_id(room_name)
+    if group_id is None:
+        set_lights(lights, command, priority)
+    else:
+        set_group(group_id, lights, command, priority)
+
+
+def get_room_group_id(room_name: str):
+    """
+    :return: the id of the bridge group containing exactly the given room's lights. None if the room has no lights,
+    the group can't be made, or provision_room_groups is yet to make it
+    """
+    return _room_group_ids.get(room_name)
+
+
+def provision_room_groups(room_lights: dict):
+    """
+    Create or update each room's bridge group on a background thread, so commands never wait on the bridge for it.
+    Until a room's group is ready, its lights are commanded individually. Call once at process start
+
+    :param room_lights: room name -> the ids of the room's lights
+    """
+    threading.Thread(target=_provision_room_groups, args=(dict(room_lights),), name='hue-groups', daemon=True).start()
+
+
+def set_group(group_id: int, lights: list, command: dict, priority: int = PRIORITY_NORMAL):
+    """
+    Queue a command to a bridge group. Once sent, the light state cache is updated with the bridge's accepted values.
+
+    :param lights: the lights in the group
+    """
+    commands.submit('groups', group_id, command, priority, lights=lights)
+
+
+def set_lights(lights, command: dict, priority: int = PRIORITY_NORMAL):
+    """
+    Queue a command to one or more lights. Once sent, the light state cache is updated with the bridge's
+    accepted values.
+
+    :param lights: a light id, or list of light ids
+    """
+    for light in (lights if isinstance(lights, list) else [lights]):
+        commands.submit('lights', light, command, priority)
+
+
+def get_light_ids() -> list:
+    """
+    :return: the ids of all lights known to the bridge, ascending
+    """
+    _refresh_if_stale()
+    return sorted(_light_states.keys())
+
+
+def is_light_on(light_id: int, wait: bool = True):
+    """
+    :param wait: whether to fetch the state of all lights if the cache is cold or too old to trust.
+    Otherwise the cache is only refreshed in the background
+    :return: whether the light is on, per the light state cache. None if not waiting and the cache can't tell
+    """
+    state = get_cached_light_state(light_id)
+    if state is None:
+        if not wait:
+            return None
+        refresh_light_states()
+        state = _light_states.get(light_id, {})
+    return state.get('on', False)
+
+
+def get_cached_light_state(light_id: int):
+    """
+    :return: the cached state of the given light, without waiting on the bridge. If older than LIGHT_STATE_TTL_S,
+    the state of all lights is fetched in the background. None if the cache is yet to be filled or older than
+    LIGHT_STATE_MAX_AGE_S, empty if the light is unknown. Do not modify.
+    """
+    if _is_stale():
+        _refresh_in_background()
+    if _is_stale(LIGHT_STATE_MAX_AGE_S):
+        return None
+    return _light_states.get(light_id, {})
+
+
+def refresh_light_states():
+    """
+    Replace the light state cache with the state of all lights, in one request
+    """
+    started = time.monotonic()
+    lights = get_client().get_lights()
+    with _light_states_lock:
+        _set_light_states(lights, started)
+
+
+def _refresh_in_background():
+    global _light_states_refreshing
+
+    with _light_states_lock:
+        if _light_states_refreshing:
+            return
+        _light_states_refreshing = True
+
+    started = time.monotonic()
+    try:
+        future = get_client().submit('GET', '/lights')
+    except Exception as e:  # The bridge is unreachable
+        future = concurrent.futures.Future()
+        future.set_exception(e)
+    future.add_done_callback(lambda future: _on_light_states_fetched(future, started))
+
+
+def _on_light_states_fetched(future, started: float):
+    global _light_states_refreshing
+
+    try:
+        lights = future.result()
+    except Exception as e:
+        logger.error("Failed to refresh light states: %s", e)
+        lights = None
+
+    with _light_states_lock:
+        _light_states_refreshing = False
+        if lights is not None:
+            _set_light_states(lights, started)
+
+
+def _set_light_states(lights: dict, started: float):
+    """
+    Replace the light state cache with a bulk fetch's lights. Hold _light_states_lock.
+
+    :param started: the time.monotonic() the fetch was requested. Lights commanded since keep their cached state,
+    as the fetch may predate the command
+    """
+    global _light_states, _light_states_refreshed
+
+    states = {int(light_id): dict(light['state']) for light_id, light in lights.items()}
+    for light_id, modified in _light_states_modified.items():
+        if modified >= started and light_id in _light_states:
+            states[light_id] = _light_states[light_id]
+    _light_states = states
+    _light_states_refreshed = time.monotonic()
+
+
+def _provision_room_groups(room_lights: dict):
+    try:
+        groups = get_bridge().get_group()
+    except Exception:
+        logger.exception("Failed to read bridge groups. Commanding room lights individually")
+        return
+    if not isinstance(groups, dict):
+        # e.g: [{'error': {...}}]
+        logger.error("Failed to read bridge groups: %s. Commanding room lights individually", groups)
+        return
+
+    for room_name, lights in room_lights.items():
+        try:
+            _room_group_ids[room_name] = _sync_room_group(room_name, lights, groups)
+        except Exception:
+            logger.exception("Failed to provision the bridge group of %s. Commanding its lights individually",
+                             room_name)
+
+
+def _sync_room_group(room_name: str, lights: list, groups: dict):
+    """
+    :param groups: the bridge's groups, group id -> group
+    """
+    if len(lights) == 0:
+        return None
+
+    group_name = GROUP_NAME_PREFIX + room_name
+    light_names = sorted(str(light) for light in lights)
+
+    bridge = get_bridge()
+    for group_id, group in groups.items():
+        if isinstance(group, dict) and group.get('name') == group_name:
+            if sorted(group.get('lights', [])) != light_names:
+                bridge.set_group(int(group_id), 'lights', lights)
+            return int(group_id)
+
+    result = bridge.create_group(group_name, lights)
+    for item in (result if isinstance(result, list) else []):
+        if isinstance(item, dict) and 'success' in item:
+            return int(item['success']['id'])
+    # e.g: The bridge's group table is full. Address lights individually instead
+    logger.error("Failed to create the bridge group of %s: %s", room_name, result)
+    return None
+
+
+def _state_has_value(state: dict, attribute: str, value) -> bool:
+    if attribute not in state:
+        return False
+    if attribute == 'xy':
+        return all(abs(a - b) <= XY_TOLERANCE for a, b in zip(state['xy'], value))
+    return state[attribute] == value
+
+
+def _is_stale(max_age_s: float = LIGHT_STATE_TTL_S) -> bool:
+    return _light_states_refreshed is None or time.monotonic() - _light_states_refreshed > max_age_s
+
+
+def _refresh_if_stale():
+    if _is_stale():
+        refresh_light_states()
+
+
+def _apply_result(result, group_lights: list = None):
+    """
+    Optimistically apply the attributes the bridge reports as set, e.g: {'success': {'/lights/1/state/bri': 254}}
+    or, for a group, {'success': {'/groups/1/action/bri': 254}}
+
+    :param group_lights: the lights of the group commanded, if any
+    """
+    if not isinstance(result, list):
+        return
 
-def command_all_lights(command: dict):
-    for light in hue.get_light_objects(mode='id'):
-        hue.set_light(light, command)
+    now = time.monotonic()
+    with _light_states_lock:
+        for light_result in result:
+            for item in (light_result if isinstance(light_result, list) else [light_result]):
+                if not isinstance(item, dict) or 'success' not in item:
+                    continue
+                for path, value in item['success'].items():
+                    parts = path.split('/')  # ['', 'lights', '1', 'state', 'bri']
+                    if len(parts) != 5 or parts[4] == 'transitiontime':
+                        continue
+                    if parts[1] == 'lights':
+                        _light_states.setdefault(int(parts[2]), {})[parts[4]] = value
+                        _light_states_modified[int(parts[2])] = now
+                    elif parts[1] == 'groups' and group_lights is not None:
+                        for light in group_lights:
+                            _light_states.setdefault(light, {})[parts[4]] = value
+                            _light_states_modified[light] = now
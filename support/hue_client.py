@@ -0,0 +1,194 @@
+"""
+An asyncio Hue bridge client that keeps HTTP connections alive between requests,
+bounds how many requests are in flight and gives every request a deadline.
+HueClient wraps it for callers that aren't coroutines.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import threading
+
+from phue import PhueRequestTimeout
+
+MAX_CONNECTIONS = 4  # The bridge serves few connections at once, and slows down beyond a handful
+REQUEST_TIMEOUT_S = 2.0
+
+
+class HueRequestTimeout(PhueRequestTimeout):
+    """
+    A request missed its deadline. Extends phue's timeout so existing handlers catch it
+    """
+    pass
+
+
+class HueClientError(Exception):
+    pass
+
+
+class AsyncHueClient:
+    def __init__(self, host: str, username: str, max_connections: int = MAX_CONNECTIONS,
+                 timeout_s: float = REQUEST_TIMEOUT_S):
+        """
+        :param host: the bridge address, optionally with a port e.g: '192.168.7.23' or '127.0.0.1:8000'
+        :param username: the whitelisted bridge username
+        :param max_connections: the most requests in flight at once
+        :param timeout_s: the default deadline of a request, including waiting for a free connection
+        """
+        host, _, port = host.partition(':')
+        self.host = host
+        self.port = int(port) if port else 80
+        self.username = username
+        self.timeout_s = timeout_s
+
+        self._max_connections = max_connections
+        self._semaphore = None  # Created on first request, in the loop that will use it
+        self._idle = []  # Open (reader, writer) pairs not serving a request
+
+    async def get_lights(self) -> dict:
+        return await self.request('GET', '/lights')
+
+    async def get_groups(self) -> dict:
+        return await self.request('GET', '/groups')
+
+    async def set_light(self, light_id: int, command: dict) -> list:
+        return await self.request('PUT', '/lights/%d/state' % light_id, command)
+
+    async def set_group(self, group_id: int, command: dict) -> list:
+        return await self.request('PUT', '/groups/%d/action' % group_id, command)
+
+    async def request(self, method: str, path: str, body=None, timeout_s: float = None):
+        """
+        :param path: the path below /api/<username>, e.g: '/lights'
+        :param body: JSON serializable request body
+        :param timeout_s: the deadline for this request. If None, the client's default
+        :return: the bridge's decoded JSON response
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_connections)
+
+        try:
+            return await asyncio.wait_for(self._request(method, path, body),
+                                          timeout_s if timeout_s is not None else self.timeout_s)
+        except asyncio.TimeoutError:
+            raise HueRequestTimeout(None, "%s %s timed out" % (method, path))
+
+    async def close(self):
+        while len(self._idle) > 0:
+            self._idle.pop()[1].close()
+
+    async def _request(self, method: str, path: str, body):
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        request = ("%s /api/%s%s HTTP/1.1\r\n"
+                   "Host: %s\r\n"
+                   "Content-Type: application/json\r\n"
+                   "Content-Length: %d\r\n"
+                   "Connection: keep-alive\r\n"
+                   "\r\n" % (method, self.username, path, self.host, len(payload))).encode('ascii') + payload
+
+        async with self._semaphore:
+            while True:
+                reused = len(self._idle) > 0
+                if reused:
+                    reader, writer = self._idle.pop()
+                else:
+                    reader, writer = await asyncio.open_connection(self.host, self.port)
+
+                try:
+                    writer.write(request)
+                    status, keep_alive, response = await self._read_response(reader)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        continue  # The bridge closed the idle connection. Retry on a new one
+                    raise
+                except BaseException:
+                    # Including cancellation by the deadline: the connection is mid-response and can't be reused
+                    writer.close()
+                    raise
+
+                if keep_alive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                break
+
+        if status != 200:
+            raise HueClientError("%s %s returned HTTP %d" % (method, path, status))
+        return json.loads(response.decode('utf-8')) if response else None
+
+    @staticmethod
+    async def _read_response(reader) -> (int, bool, bytes):
+        """
+        :return: the status code, whether the connection may be reused, and the body
+        """
+        status_line = await reader.readuntil(b'\r\n')
+        version, status = status_line.split(b' ')[:2]
+
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+        if 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)  # Each chunk ends with CRLF
+                if size == 0:
+                    break
+                body += chunk[:-2]
+        else:
+            body = await reader.read()  # Delimited by the bridge closing the connection
+            keep_alive = False
+
+        return int(status), keep_alive, body
+
+
+class HueClient:
+    """
+    Runs an AsyncHueClient on its own event loop thread, for callers that aren't coroutines
+    """
+
+    def __init__(self, host: str, username: str, max_connections: int = MAX_CONNECTIONS,
+                 timeout_s: float = REQUEST_TIMEOUT_S):
+        self.client = AsyncHueClient(host, username, max_connections, timeout_s)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='hue-client', daemon=True)
+        self._thread.start()
+
+    def submit(self, method: str, path: str, body=None, timeout_s: float = None) -> concurrent.futures.Future:
+        """
+        Start a request without waiting for it. See AsyncHueClient.request
+        :return: a future of the decoded response
+        """
+        return asyncio.run_coroutine_threadsafe(self.client.request(method, path, body, timeout_s), self._loop)
+
+    def request(self, method: str, path: str, body=None, timeout_s: float = None):
+        """
+        Make a request and wait for the response. See AsyncHueClient.request
+        """
+        return self.submit(method, path, body, timeout_s).result()
+
+    def get_lights(self) -> dict:
+        return self.request('GET', '/lights')
+
+    def get_groups(self) -> dict:
+        return self.request('GET', '/groups')
+
+    def set_light(self, light_id: int, command: dict) -> list:
+        return self.request('PUT', '/lights/%d/state' % light_id, command)
+
+    def set_group(self, group_id: int, command: dict) -> list:
+        return self.request('PUT', '/groups/%d/action' % group_id, command)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.client.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
@@ -5,16 +5,24 @@ from phue import PhueRequestTimeout
 
 from support import env
 from support.color import adjust_command_for_time, get_current_circadian_color
-from support.hue import hue, COMMAND_FULL_ON, COMMAND_OFF
+from support.hue import COMMAND_FULL_ON, COMMAND_OFF, PRIORITY_MOTION, PRIORITY_NORMAL, set_room_lights, is_light_on
+from support.hue_client import HueClientError
 from support.logger import get_logger
 
 logger = get_logger("rooms")
 
+# Raised by the bridge client and phue when the bridge times out, errs or can't be reached
+HUE_ERRORS = (PhueRequestTimeout, HueClientError, OSError)
+
 PIN_NO_PIN = -1  # For rooms without motion capabilities
 PIN_EXTERNAL_SENSOR = -2  # For rooms with motion sensed externally. Use env.get_room_last_motion_date to check state
 
 
 class Room:
+    __slots__ = ('name', 'lights', 'motion_pin', 'motion_timeout',
+                 'motion_started', 'luminance_lux', 'temp_fahrenheit',
+                 '_holds_state', '_last_motion', '_occupied')
+
     def __init__(self,
                  name: str,
                  lights: [int],
@@ -35,15 +43,53 @@ class Room:
         self.luminance_lux = -1.0
         self.temp_fahrenheit = -1.0
 
+        # Until load_state(), last motion and occupancy are read from and written to the database directly
+        self._holds_state = False
+        self._last_motion = None
+        self._occupied = False
+
     def __repr__(self):
         return self.name
 
+    def load_state(self, snapshot: env.HomeSnapshot = None):
+        """
+        Make this object the source of truth for the room's last motion and occupancy.
+        Call from the one process that records motion. The state last persisted is loaded,
+        and later changes are written to the database behind the caller's back.
+
+        :param snapshot: the home state to load from. If None, a new one is read
+        """
+        if snapshot is None:
+            snapshot = env.snapshot()
+
+        self._last_motion = snapshot.get_room_last_motion_date(self.name)
+        self._occupied = snapshot.get_room_occupied(self.name)
+        self._holds_state = True
+
     def set_last_motion(self, motion_datetime:datetime):
-        env.set_room_last_motion_date(self.name, motion_datetime)
+        if self._holds_state:
+            self._last_motion = motion_datetime
+            env.queue_room_last_motion_date(self.name, motion_datetime)
+        else:
+            env.set_room_last_motion_date(self.name, motion_datetime)
 
     def get_last_motion(self) -> datetime:
+        if self._holds_state:
+            return self._last_motion
         return env.get_room_last_motion_date(self.name)
 
+    def set_occupied(self, occupied: bool):
+        if self._holds_state:
+            self._occupied = occupied
+            env.queue_room_occupied(self.name, occupied)
+        else:
+            env.set_room_occupied(self.name, occupied)
+
+    def is_occupied(self) -> bool:
+        if self._holds_state:
+            return self._occupied
+        return env.get_room_occupied(self.name)
+
     def on_motion(self, motion_datetime: datetime, is_motion_start: bool = True):
 
         self.set_last_motion(motion_datetime)
@@ -56,7 +102,8 @@ class Room:
         circadian_color = get_current_circadian_color(date=motion_datetime)
 
         if is_motion_start and circadian_color.brightness > 0:
-            self.switch(True, adjust_hue_for_time=False, extra_command=circadian_color.apply_to_command({}))
+            self.switch(True, adjust_hue_for_time=False, extra_command=circadian_color.apply_to_command({}),
+                        priority=PRIORITY_MOTION)
 
     def is_motion_timed_out(self, as_of_date: datetime) -> bool:
         # A room in motion shall not be timed out
@@ -80,10 +127,12 @@ class Room:
 
         return timed_out
 
-    def switch(self, on: bool, adjust_hue_for_time: bool=True, extra_command: dict = None):
+    def switch(self, on: bool, adjust_hue_for_time: bool=True, extra_command: dict = None,
+               priority: int = PRIORITY_NORMAL):
 
-        # Ignore requests that won't change state
-        if self.is_lit() == on:
+        # Ignore requests that won't change state. Never waits on the bridge: if the lights' state isn't
+        # cached, the command is sent, and the command scheduler drops it if it changes nothing
+        if self.is_lit(wait=False) == on:
             return
 
         command = copy.deepcopy(COMMAND_FULL_ON if on else COMMAND_OFF)  # Don't alter reference command
@@ -95,7 +144,7 @@ class Room:
 
         logger.info("Powering " + ("on" if on else "off") + " " + self.name + " lights.")
 
-        self.update(command)
+        self.update(command, priority)
 
     def dim(self, brightness: float = .5, transitiontime_s: int=5):
 
@@ -106,29 +155,42 @@ class Room:
             'bri': int(min(254, 254 * brightness))
         })
 
-    def update(self, command: dict):
+    def update(self, command: dict, priority: int = PRIORITY_NORMAL):
+        """
+        Queue a command to all lights in this room
+        :param priority: one of support.hue's PRIORITY_ constants
+        """
         logger.info("Sending %s to %s", str(command), self.name)
         try:
-            result = hue.set_light(self.lights, command)
-            logger.info("Update result %s", str(result))
-        except PhueRequestTimeout:
+            set_room_lights(self.name, self.lights, command, priority)
+        except HUE_ERRORS:
             logger.error("Failed to update room '%s'" % self.name)
 
-    def is_lit(self):
+    def is_lit(self, wait: bool = True):
+        """
+        :param wait: whether to fetch light state from the bridge if the cache is cold or too old to trust
+        :return: whether any of the room's lights is on, per the light state cache. None if not waiting
+        and the cache can't tell
+        """
+        lit = False
         try:
             for light in self.lights:
-                if hue.get_light(light, 'on'):
+                light_on = is_light_on(light, wait)
+                if light_on:
                     return True
-        except PhueRequestTimeout:
+                if light_on is None:
+                    lit = None
+        except HUE_ERRORS:
             logger.error("Failed to query whether room '%s' is lit" % self.name)
 
-        return False
+        return lit
 
 
 class LightsOnDuringDayRoom(Room):
     """
     A Room that interprets the lights-off 'Day' CircadianColor with full brightness lighting
     """
+    __slots__ = ()
 
     def on_motion(self, motion_datetime: datetime, is_motion_start: bool = True):
         self.set_last_motion(motion_datetime)
@@ -146,13 +208,14 @@ class LightsOnDuringDayRoom(Room):
                 command['bri'] = 255
                 command['xy'] = circadian_color.color_xy
 
-            self.switch(True, adjust_hue_for_time=False, extra_command=command)
+            self.switch(True, adjust_hue_for_time=False, extra_command=command, priority=PRIORITY_MOTION)
 
 
 class GuestModeRoom(Room):
     """
     A Room that does not switch lights in response to motion while in Guest Mode.
     """
+    __slots__ = ()
 
     def on_motion(self, motion_datetime: datetime, is_motion_start: bool = True):
         logger.info("GuestModeRoom on_motion. Guest mode %s", str(env.is_guest_mode()))
@@ -0,0 +1,242 @@
+"""
+Sensor sources run inside motion.py, each publishing SensorEvents onto one SensorBus, which motion.py consumes.
+Every kind of sensor is handled the same way, and a new kind only needs a SensorSource, not a daemon of its own.
+
+Zigbee sensors are still read by zigbee.py, which must be python 2 for KillerBee: ZigbeeUdpSource receives its frames.
+"""
+
+import abc
+import asyncio
+import datetime
+import struct
+import threading
+
+from support.env import EVENT_MOTION, EVENT_LUMINANCE, EVENT_TEMPERATURE
+from support.logger import get_logger
+from support.time_utils import LOCAL_TIMEZONE, get_local_time
+from support.zigbee_protocol import READING_MOTION, READING_LUMINANCE, READING_TEMPERATURE, ProtocolError, \
+    SequenceTracker, decode_frame
+
+logger = get_logger("sensors")
+
+READING_TYPE_TO_EVENT = {
+    READING_MOTION: EVENT_MOTION,
+    READING_LUMINANCE: EVENT_LUMINANCE,
+    READING_TEMPERATURE: EVENT_TEMPERATURE,
+}
+
+BLE_RECONNECT_DELAY_S = 5
+BLE_NOTIFICATION_WAIT_S = 1.0  # How often the BLE thread checks whether it was stopped
+BLE_MOTION_CHARACTERISTIC_HANDLE = 14  # Writing 0x0001 here enables the sensor's motion notifications
+
+
+class SensorEvent:
+    __slots__ = ('kind', 'room_name', 'value', 'date')
+
+    def __init__(self, kind: str, room_name: str, value: float, date: datetime.datetime = None):
+        """
+        :param kind: one of env.EVENT_MOTION, EVENT_LUMINANCE or EVENT_TEMPERATURE
+        :param value: as recorded by env.record_sensor_event, e.g: 1 for motion start, 0 for stop
+        :param date: when the reading was taken, and so when handlers take it to have happened. If None, now
+        """
+        self.kind = kind
+        self.room_name = room_name
+        self.value = value
+        self.date = date if date is not None else get_local_time()
+
+    def __repr__(self):
+        return "SensorEvent(%s, %s, %r, %s)" % (self.kind, self.room_name, self.value, self.date)
+
+
+class SensorBus:
+    """
+    A queue of SensorEvents, published from any thread and consumed on an event loop
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.events_published = 0
+
+        self._queue = asyncio.Queue()
+
+    def publish(self, event: SensorEvent):
+        self.events_published += 1
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, event)
+
+    async def consume(self, handler: callable):
+        """
+        Call handler with each event, in the order published. Run on the bus's loop
+        """
+        while True:
+            event = await self._queue.get()
+            try:
+                handler(event)
+            except Exception:
+                logger.exception("Failed to handle %s", event)
+
+
+class SensorSource(abc.ABC):
+    """
+    A source of sensor readings, published as SensorEvents
+    """
+
+    def __init__(self, publish: callable):
+        """
+        :param publish: called with each SensorEvent, from any thread. e.g: SensorBus.publish
+        """
+        self.publish = publish
+
+    @abc.abstractmethod
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """
+        Begin publishing events. Call before loop runs
+        """
+
+    def stop(self):
+        pass
+
+
+class ZigbeeUdpSource(SensorSource, asyncio.DatagramProtocol):
+    """
+    Receives frames of readings forwarded by zigbee.py over UDP, on the loop
+    """
+
+    def __init__(self, publish: callable, addr_to_room_name: dict, address: tuple):
+        """
+        :param addr_to_room_name: sensor Zigbee address -> the name of the room it senses
+        :param address: the (host, port) zigbee.py sends to
+        """
+        SensorSource.__init__(self, publish)
+        self.addr_to_room_name = addr_to_room_name
+        self.address = address
+        self.sequences = SequenceTracker()
+
+        self._transport = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._transport, _ = loop.run_until_complete(
+            loop.create_datagram_endpoint(lambda: self, local_addr=self.address))
+
+    def stop(self):
+        if self._transport is not None:
+            self._transport.close()
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            sequence, readings = decode_frame(data)
+        except ProtocolError as e:
+            logger.info("Got unrecognized zigbee socket data %s: %s", data, e)
+            return
+
+        dropped = self.sequences.track(sequence)
+        if dropped > 0:
+            logger.warn("Lost %d zigbee frames before frame %d. %d lost of %d received in all",
+                        dropped, sequence, self.sequences.frames_dropped, self.sequences.frames_received)
+
+        for reading_type, addr, val, timestamp in readings:
+            kind = READING_TYPE_TO_EVENT.get(reading_type)
+            if addr not in self.addr_to_room_name:
+                logger.warn("Got zigbee reading from unknown addr %d", addr)
+            elif kind is None:
+                logger.warn("Got zigbee reading with unknown type %d", reading_type)
+            else:
+                # Readings may have waited for a batch: date them when zigbee.py decoded them
+                reading_date = datetime.datetime.fromtimestamp(timestamp, LOCAL_TIMEZONE)
+                self.publish(SensorEvent(kind, self.addr_to_room_name[addr], val, reading_date))
+
+
+class BleSource(SensorSource):
+    """
+    Connects to a BLE motion sensor on a thread of its own, reconnecting when the connection drops.
+    The sensor notifies on motion, but not when it stops, so each notification is published as
+    a motion start then stop: the room times out after its last notification.
+
+    To configure and enable BLE::
+
+        sudo hciconfig hci0 down
+        sudo btmgmt le on
+        sudo btmgmt bredr off
+        sudo hciconfig hci0 up
+    """
+
+    def __init__(self, publish: callable, mac: str, room_name: str):
+        """
+        :param mac: the sensor's BLE address, e.g: "D4:02:D4:BF:E5:2B"
+        """
+        SensorSource.__init__(self, publish)
+        self.mac = mac
+        self.room_name = room_name
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ble-%s' % mac, daemon=True)
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def on_notification(self):
+        logger.info("Got BLE motion notification for %s", self.room_name)
+        date = get_local_time()
+        self.publish(SensorEvent(EVENT_MOTION, self.room_name, 1, date))
+        self.publish(SensorEvent(EVENT_MOTION, self.room_name, 0, date))
+
+    def _run(self):
+        from bluepy.bluepy.btle import Peripheral, DefaultDelegate, BTLEException
+
+        source = self
+
+        class BleDelegate(DefaultDelegate):
+            def handleNotification(self, cHandle, data):
+                source.on_notification()
+
+        while not self._stopped.is_set():
+            try:
+                logger.info("Connecting to BLE motion sensor %s...", self.mac)
+                peripheral = Peripheral(self.mac, "random")
+                logger.info("Connected to BLE motion sensor %s", self.mac)
+                peripheral.withDelegate(BleDelegate())
+
+                peripheral.writeCharacteristic(BLE_MOTION_CHARACTERISTIC_HANDLE, struct.pack('<bb', 0x01, 0x00),
+                                               withResponse=True)
+
+                while not self._stopped.is_set():
+                    peripheral.waitForNotifications(BLE_NOTIFICATION_WAIT_S)
+                peripheral.disconnect()
+
+            except BTLEException:
+                logger.exception("BLE Error")
+                self._stopped.wait(BLE_RECONNECT_DELAY_S)
+
+
+class GpioSource(SensorSource):
+    """
+    Reads motion sensors wired to the Raspberry Pi's GPIO pins, which are high while there's motion
+    """
+
+    def __init__(self, publish: callable, pin_to_room_name: dict):
+        """
+        :param pin_to_room_name: BCM pin number -> the name of the room its sensor senses
+        """
+        SensorSource.__init__(self, publish)
+        self.pin_to_room_name = pin_to_room_name
+
+        self._gpio = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        import RPi.GPIO as GPIO
+
+        self._gpio = GPIO
+        GPIO.setmode(GPIO.BCM)
+        for pin in self.pin_to_room_name.keys():
+            GPIO.setup(pin, GPIO.IN)
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.on_edge)
+
+    def stop(self):
+        if self._gpio is not None:
+            self._gpio.cleanup()
+
+    def on_edge(self, pin: int):
+        # On RPi.GPIO's callback thread
+        self.publish(SensorEvent(EVENT_MOTION, self.pin_to_room_name[pin], 1 if self._gpio.input(pin) else 0))
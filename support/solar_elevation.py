@@ -0,0 +1,161 @@
+"""
+A precomputed table of the sun's elevation, at one minute resolution for a whole year, for fast
+time-at-elevation and elevation-at-time lookups without solving astral per query.
+"""
+
+import datetime
+import os
+import threading
+
+import numpy as np
+import pytz
+
+from support.env import DB_FOLDER
+
+RESOLUTION_S = 60
+MARGIN = datetime.timedelta(days=2)  # Tables extend past their year, for local days spanning UTC years
+
+_tables = {}  # (year, latitude, longitude) -> SolarElevationTable
+_tables_lock = threading.Lock()
+
+
+class SolarElevationTable:
+    def __init__(self, start_timestamp: float, elevations: np.ndarray):
+        """
+        :param start_timestamp: POSIX timestamp of the first entry
+        :param elevations: geometric solar elevation in degrees every RESOLUTION_S seconds from start_timestamp
+        """
+        self.start_timestamp = start_timestamp
+        self.elevations = elevations
+
+    def get_elevation(self, date: datetime) -> float:
+        """
+        :return: the solar elevation at date, interpolated between table entries
+        """
+        position = (date.timestamp() - self.start_timestamp) / RESOLUTION_S
+        idx = int(position)
+        fraction = position - idx
+        return float(self.elevations[idx] * (1 - fraction) + self.elevations[idx + 1] * fraction)
+
+    def get_time_at_elevation(self, elevation_deg: float, day_start: datetime, day_end: datetime,
+                              rising: bool) -> (float, float):
+        """
+        :param day_start: the start of the day to search
+        :param day_end: the end of the day to search
+        :param rising: whether to find the morning crossing, otherwise the evening one
+        :return: the POSIX timestamp the sun crosses elevation_deg, and the elevation actually found. If the sun
+        never reaches elevation_deg that day, the elevation is moved toward the horizon whole degrees at a time
+        until it is reached
+        """
+        i0 = int((day_start.timestamp() - self.start_timestamp) // RESOLUTION_S)
+        i1 = int((day_end.timestamp() - self.start_timestamp) // RESOLUTION_S) + 1
+        day = self.elevations[i0:i1]
+
+        # Within a day the sun rises monotonically from its lowest to its highest, then sets again
+        noon = int(np.argmax(day))
+        if rising:
+            low = int(np.argmin(day[:noon + 1]))
+            offset, half = low, day[low:noon + 1]
+        else:
+            low = noon + int(np.argmin(day[noon:]))
+            offset, half = noon, day[low:noon - 1 if noon > 0 else None:-1]  # Reversed, so ascending too
+
+        lowest, highest = float(half[0]), float(half[-1])
+        if elevation_deg > highest:
+            elevation_deg -= np.ceil(elevation_deg - highest)
+        elif elevation_deg < lowest:
+            elevation_deg += np.ceil(lowest - elevation_deg)
+        elevation_deg = min(max(elevation_deg, lowest), highest)
+
+        # O(log n): the first entry at or above the elevation, interpolated with the entry before it
+        idx = int(np.searchsorted(half, elevation_deg))
+        if idx == 0:
+            position = 0.0
+        else:
+            below, above = float(half[idx - 1]), float(half[idx])
+            position = idx - 1 + ((elevation_deg - below) / (above - below) if above > below else 0.0)
+
+        if not rising:
+            position = (low - offset) - position  # Back to minutes after noon, from the reversed half
+        return self.start_timestamp + (i0 + offset + position) * RESOLUTION_S, float(elevation_deg)
+
+
+def get_table(year: int, latitude: float, longitude: float) -> SolarElevationTable:
+    """
+    :return: the table covering the given UTC year (plus MARGIN either side), loaded from disk or computed and saved
+    """
+    key = (year, round(latitude, 4), round(longitude, 4))
+    with _tables_lock:
+        table = _tables.get(key)
+        if table is None:
+            table = _load_or_build(*key)
+            _tables[key] = table
+        return table
+
+
+def solar_elevations(timestamps: np.ndarray, latitude: float, longitude: float) -> np.ndarray:
+    """
+    Geometric (unrefracted) solar elevation, per NOAA's solar position equations
+
+    :param timestamps: POSIX timestamps
+    :return: elevation in degrees at each timestamp
+    """
+    julian_day = timestamps / 86400.0 + 2440587.5
+    jc = (julian_day - 2451545.0) / 36525.0  # Julian century
+
+    mean_long = np.mod(280.46646 + jc * (36000.76983 + jc * 0.0003032), 360)
+    mean_anomaly = 357.52911 + jc * (35999.05029 - 0.0001537 * jc)
+    eccentricity = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    anomaly_rad = np.radians(mean_anomaly)
+    center = (np.sin(anomaly_rad) * (1.914602 - jc * (0.004817 + 0.000014 * jc)) +
+              np.sin(2 * anomaly_rad) * (0.019993 - 0.000101 * jc) +
+              np.sin(3 * anomaly_rad) * 0.000289)
+    omega = np.radians(125.04 - 1934.136 * jc)
+    apparent_long = mean_long + center - 0.00569 - 0.00478 * np.sin(omega)
+
+    mean_obliquity = 23 + (26 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60) / 60
+    obliquity = np.radians(mean_obliquity + 0.00256 * np.cos(omega))
+    declination = np.arcsin(np.sin(obliquity) * np.sin(np.radians(apparent_long)))
+
+    y = np.tan(obliquity / 2) ** 2
+    mean_long_rad = np.radians(mean_long)
+    equation_of_time_min = 4 * np.degrees(y * np.sin(2 * mean_long_rad) -
+                                          2 * eccentricity * np.sin(anomaly_rad) +
+                                          4 * eccentricity * y * np.sin(anomaly_rad) * np.cos(2 * mean_long_rad) -
+                                          0.5 * y * y * np.sin(4 * mean_long_rad) -
+                                          1.25 * eccentricity * eccentricity * np.sin(2 * anomaly_rad))
+
+    utc_minutes = np.mod(timestamps, 86400) / 60.0
+    true_solar_minutes = np.mod(utc_minutes + equation_of_time_min + 4 * longitude, 1440)
+    hour_angle = np.radians(true_solar_minutes / 4 - 180)
+
+    latitude_rad = np.radians(latitude)
+    cos_zenith = (np.sin(latitude_rad) * np.sin(declination) +
+                  np.cos(latitude_rad) * np.cos(declination) * np.cos(hour_angle))
+    return 90 - np.degrees(np.arccos(np.clip(cos_zenith, -1, 1)))
+
+
+def _load_or_build(year: int, latitude: float, longitude: float) -> SolarElevationTable:
+    start = datetime.datetime(year, 1, 1, tzinfo=pytz.utc) - MARGIN
+    end = datetime.datetime(year + 1, 1, 1, tzinfo=pytz.utc) + MARGIN
+    start_timestamp = start.timestamp()
+
+    path = os.path.join(DB_FOLDER, 'solar_elevation_%d_%.4f_%.4f.npy' % (year, latitude, longitude))
+    if os.path.exists(path):
+        return SolarElevationTable(start_timestamp, np.load(path))
+
+    count = int((end - start).total_seconds()) // RESOLUTION_S + 1
+    timestamps = start_timestamp + np.arange(count, dtype=np.float64) * RESOLUTION_S
+    elevations = solar_elevations(timestamps, latitude, longitude).astype(np.float32)
+
+    try:
+        if not os.path.exists(DB_FOLDER):
+            os.makedirs(DB_FOLDER)
+        # Write then rename, so a concurrent process never loads a partial table
+        partial_path = path + '.%d.partial.npy' % os.getpid()
+        np.save(partial_path, elevations)
+        os.rename(partial_path, path)
+    except OSError:
+        pass  # Rebuilt next process start instead
+
+    return SolarElevationTable(start_timestamp, elevations)
@@ -1,6 +1,8 @@
 import datetime
+import threading
 
 import astral
+import pytz
 from pytz import timezone
 
 # from enum import Enum
@@ -9,9 +11,8 @@ CITY_NAME = 'San Francisco'  # For Sunrise / Sunset detection. Supported cities:
 
 LOCAL_TIMEZONE = timezone('US/Pacific')  # For logging datetimes
 
-_astral = astral.Astral()
-_astral.solar_depression = 'civil'
-astral_city = _astral[CITY_NAME]
+_astral_city = None  # Built on first use: parsing astral's city database is slow on a Pi
+_astral_city_lock = threading.Lock()
 
 # Enums aren't a thing until python 3.5. RPi repository only has 3.4
 # class CircadianEvent(Enum):
@@ -23,6 +24,17 @@ SUNSET = "sunset"
 DUSK = "dusk"
 
 
+def get_astral_city() -> astral.Location:
+    global _astral_city
+
+    with _astral_city_lock:
+        if _astral_city is None:
+            _astral = astral.Astral()
+            _astral.solar_depression = 'civil'
+            _astral_city = _astral[CITY_NAME]
+        return _astral_city
+
+
 def get_local_time() -> datetime:
     return datetime.datetime.now(LOCAL_TIMEZONE)
 
@@ -31,53 +43,87 @@ def get_local_sunset(date: datetime = None) -> datetime:
     if date is None:
         date = datetime.datetime.now(LOCAL_TIMEZONE)
 
-    return astral_city.sun(date=date, local=True)['sunset']
+    return get_astral_city().sun(date=date, local=True)['sunset']
 
 
 def get_local_dusk(date: datetime = None) -> datetime:
     if date is None:
         date = datetime.datetime.now(LOCAL_TIMEZONE)
 
-    return astral_city.sun(date=date, local=True)['dusk']
+    return get_astral_city().sun(date=date, local=True)['dusk']
 
 
 def get_local_dawn(date: datetime = None) -> datetime:
     if date is None:
         date = datetime.datetime.now(LOCAL_TIMEZONE)
 
-    return astral_city.sun(date=date, local=True)['dawn']
+    return get_astral_city().sun(date=date, local=True)['dawn']
 
 
 def get_local_sunrise(date: datetime = None) -> datetime:
     if date is None:
         date = datetime.datetime.now(LOCAL_TIMEZONE)
 
-    return astral_city.sun(date=date, local=True)['sunrise']
+    return get_astral_city().sun(date=date, local=True)['sunrise']
 
 
 def get_local_noon(date: datetime = None) -> datetime:
     if date is None:
         date = datetime.datetime.now(LOCAL_TIMEZONE)
 
-    return astral_city.sun(date=date, local=True)['noon']
+    return get_astral_city().sun(date=date, local=True)['noon']
 
 
 def get_time_at_first_lit_elevation(date: datetime = None):
-    return astral_city.time_at_elevation(elevation=10, date=date)
+    return get_astral_city().time_at_elevation(elevation=10, date=date)
 
 
 def get_local_solar_elevation(date: datetime = None):
-    return astral_city.solar_elevation(dateandtime=date)
+    return get_astral_city().solar_elevation(dateandtime=date)
 
 
-def get_time_at_elevation(elevation_deg: float, date: datetime = None, direction=astral.SUN_SETTING):
+def get_solar_position(date: datetime = None) -> (float, int):
+    """
+    :return: the sun's geometric elevation at date, in degrees, and whether it's astral.SUN_RISING or
+    astral.SUN_SETTING
+    """
+    from support.solar_elevation import RESOLUTION_S, get_table
+
+    if date is None:
+        date = get_local_time()
 
-    while True:
-        try:
-            return astral_city.time_at_elevation(elevation_deg, direction=direction, date=date, local=True)
-        except astral.AstralError:
-            print("Sun does not reach elevation %f, trying another" % elevation_deg)
-            if elevation_deg >= 0:
-                return get_time_at_elevation(elevation_deg-1, date, direction)
-            else:
-                return get_time_at_elevation(elevation_deg+1, date, direction)
\ No newline at end of file
+    city = get_astral_city()
+    table = get_table(date.astimezone(pytz.utc).year, city.latitude, city.longitude)
+    elevation_deg = table.get_elevation(date)
+    later_elevation_deg = table.get_elevation(date + datetime.timedelta(seconds=RESOLUTION_S))
+    return elevation_deg, astral.SUN_RISING if later_elevation_deg > elevation_deg else astral.SUN_SETTING
+
+
+def get_time_at_elevation(elevation_deg: float, date: datetime = None, direction=astral.SUN_SETTING) -> datetime:
+    """
+    :param date: the local day to search. If None, today
+    :param direction: astral.SUN_RISING or astral.SUN_SETTING
+    :return: the local time the sun crosses elevation_deg on date's day. If the sun never reaches elevation_deg
+    that day, the time it crosses the nearest elevation, whole degrees toward the horizon, that it does reach
+    """
+    # Imported here so processes that never ask, e.g: the web server, don't pay for loading NumPy
+    from support.solar_elevation import get_table
+
+    if date is None:
+        date = get_local_time()
+    if isinstance(date, datetime.datetime):
+        if date.tzinfo is not None:
+            date = date.astimezone(LOCAL_TIMEZONE)
+        date = date.date()
+
+    day_start = LOCAL_TIMEZONE.localize(datetime.datetime.combine(date, datetime.time()))
+    day_end = LOCAL_TIMEZONE.localize(datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time()))
+
+    city = get_astral_city()
+    table = get_table(day_start.astimezone(pytz.utc).year, city.latitude, city.longitude)
+    timestamp, found_elevation_deg = table.get_time_at_elevation(elevation_deg, day_start, day_end,
+                                                                 rising=direction == astral.SUN_RISING)
+    if found_elevation_deg != elevation_deg:
+        print("Sun does not reach elevation %f, using %f" % (elevation_deg, found_elevation_deg))
+
+    return datetime.datetime.fromtimestamp(round(timestamp), LOCAL_TIMEZONE)
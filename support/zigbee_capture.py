@@ -0,0 +1,137 @@
+"""
+Captures frames from a KillerBee radio on a thread of its own, so the radio is read at its own pace
+whatever decoding costs. Or reads them from a capture file, to decode without a radio.
+
+Note this must stay a python 2 compatible module: zigbee.py imports it
+"""
+
+import collections
+import threading
+
+from support.zigbee_frames import ieee802154_fcs
+
+RING_CAPACITY = 1024  # Frames buffered between capture and decode. Around 10 s of a busy channel
+
+CAPTURE_TIMEOUT_MS = 100  # The longest a read blocks on the radio, and so the longest stop() waits
+CAPTURE_ERROR_DELAY_S = 1.0  # Wait after a failed read, e.g: the radio was unplugged, rather than spin on it
+
+
+class FrameRing:
+    """
+    A bounded FIFO of frames between threads. When full, the oldest frame is dropped and counted
+    """
+
+    def __init__(self, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self.overflowed = 0  # Frames dropped because the ring was full
+
+        self._frames = collections.deque()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame):
+        with self._condition:
+            if len(self._frames) >= self.capacity:
+                self._frames.popleft()
+                self.overflowed += 1
+            self._frames.append(frame)
+            self._condition.notify()
+
+    def take(self, max_count, timeout_s=None):
+        '''
+        Wait up to timeout_s for a frame
+        :return: up to max_count of the oldest frames, removed from the ring. Empty if none arrived in time
+        '''
+        with self._condition:
+            if len(self._frames) == 0:
+                self._condition.wait(timeout_s)
+
+            frames = []
+            while len(frames) < max_count and len(self._frames) > 0:
+                frames.append(self._frames.popleft())
+            return frames
+
+
+class CaptureThread(threading.Thread):
+    """
+    Reads frames from the radio into a FrameRing, skipping those accept() rejects.
+    Each read blocks until a frame arrives, or CAPTURE_TIMEOUT_MS passes
+    """
+
+    def __init__(self, kb, ring, accept, logger):
+        '''
+        :param kb: a KillerBee instance, with its sniffer on
+        :param accept: a function of a frame's bytes, and whether the radio found its FCS valid,
+        returning whether it should be decoded
+        '''
+        threading.Thread.__init__(self, name='zigbee-capture')
+        self.daemon = True
+
+        self.kb = kb
+        self.ring = ring
+        self.accept = accept
+        self.logger = logger
+
+        self.frames_seen = 0
+        self.frames_filtered = 0
+
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                packet = self.kb.pnext(timeout=CAPTURE_TIMEOUT_MS)
+            except:
+                self.logger.exception("Unable to fetch packet")
+                self._stopped.wait(CAPTURE_ERROR_DELAY_S)
+                continue
+
+            if packet is None:
+                continue  # Nothing within the timeout
+
+            self.frames_seen += 1
+            if not self.accept(packet['bytes'], packet.get('validcrc')):
+                self.frames_filtered += 1
+                continue
+            self.ring.put(packet['bytes'])
+
+
+# pcap link types of 802.15.4 captures
+DLT_IEEE802_15_4_WITHFCS = 195
+DLT_IEEE802_15_4_NOFCS = 230
+
+
+def read_pcap_frames(path):
+    '''
+    Read 802.15.4 frames from a pcap or pcapng capture, e.g: one saved by Wireshark or KillerBee's zbdump
+    :return: a generator of each frame's bytes, with FCS as the radio delivers them, and the POSIX time it was captured
+    '''
+    from scapy.utils import RawPcapReader
+
+    reader = RawPcapReader(path)
+    try:
+        for frame, metadata in reader:
+            # pcapng gives each packet its interface's link type, pcap one for the whole file
+            linktype = getattr(metadata, 'linktype', None)
+            if linktype is None:
+                linktype = reader.linktype
+
+            if hasattr(metadata, 'tsresol'):
+                timestamp = ((metadata.tshigh << 32) + metadata.tslow) / float(metadata.tsresol)
+            else:
+                timestamp = metadata.sec + metadata.usec / (1e9 if getattr(reader, 'nano', False) else 1e6)
+
+            if linktype == DLT_IEEE802_15_4_WITHFCS:
+                yield frame, timestamp
+            elif linktype == DLT_IEEE802_15_4_NOFCS:
+                yield frame + ieee802154_fcs(frame), timestamp
+            else:
+                raise ValueError("%s has link type %d, not 802.15.4" % (path, linktype))
+    finally:
+        reader.close()
+
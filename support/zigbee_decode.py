@@ -0,0 +1,106 @@
+"""
+Decodes sniffed Zigbee frames from our sensors into readings. Pure functions of the frame bytes,
+so frames can be decoded in worker processes.
+
+Note because of killerbee this must be a python 2 module
+"""
+
+import signal
+from struct import unpack
+
+from scapy.all import *
+from killerbee.scapy_extensions import *
+
+from support.zigbee_addrs import SENSOR_ADDR_TO_NAME
+from support.zigbee_protocol import READING_MOTION, READING_LUMINANCE, READING_TEMPERATURE
+
+# Unit conversion constants
+
+LUMINANCE_TO_LUX = 0.0010171925257971555
+
+_worker_network_key = None  # Set in each decode worker process by init_decode_worker
+
+
+def celsius_to_fahrenheit(celsius):
+    return (celsius * 9 / 5.0) + 32
+
+def detect_encryption(pkt):
+    '''detect_entryption: Does this packet have encrypted information? Return: True or False'''
+    if not pkt.haslayer(ZigbeeSecurityHeader) or not pkt.haslayer(ZigbeeNWK):
+        return False
+    return True
+
+def detect_layer(pkt, layer):
+    '''detect_entryption: Does this packet have encrypted information? Return: True or False'''
+    # if not pkt.haslayer(ZigbeeAppDataPayload):
+    if not pkt.haslayer(layer):
+        return False
+    return True
+
+def decode_sensor_frame(frame, network_key):
+    '''
+    :param frame: the raw 802.15.4 frame bytes, with FCS
+    :param network_key: the Zigbee network key, to decrypt the frame's payload
+    :return: the list of (reading type, sensor address, value) readings in the frame, and a list of warnings
+    '''
+    readings = []
+    warnings = []
+
+    try:
+        # Decoded whatever the FCS: some radios put RSSI and LQI where it goes
+        scapy_packet = Dot15d4FCS(frame)
+    except:
+        warnings.append("Unable to parse 802.15.4 packet: %s" % frame.encode('hex'))
+        return readings, warnings
+
+    if not detect_layer(scapy_packet, ZigbeeSecurityHeader):
+        return readings, warnings
+    source = scapy_packet.getlayer(ZigbeeSecurityHeader).fields['source']
+    if source not in SENSOR_ADDR_TO_NAME or not detect_encryption(scapy_packet):
+        return readings, warnings
+
+    # Data from motion sensor
+    enc_data = kbdecrypt(scapy_packet, network_key)
+    # First determine if this is an occupancy sensing
+    if not (detect_layer(enc_data, ZigbeeAppDataPayload) and detect_layer(enc_data, ZigbeeClusterLibrary)):
+        return readings, warnings
+
+    app_bytes = enc_data.getlayer(ZigbeeAppDataPayload).payload.__bytes__()
+    cluster_bytes = enc_data.getlayer(ZigbeeClusterLibrary).payload.__bytes__()
+    # Occupancy Sensing
+    if app_bytes[:4] == '\x06\x04\x04\x01':  # Cluster: Occupancy Sensing (0x0406), Profile: Home Automation (0x0104)
+        if cluster_bytes[-4:-1] == '\x00\x00\x18':  # Occupancy Sensing, 8-Bit bitmap
+            is_motion_start = cluster_bytes[-1] == '\x01'
+            readings.append((READING_MOTION, source, is_motion_start))
+        else:
+            warnings.append("Unknown Motion packet. Cluster: %s" % cluster_bytes.encode('hex'))
+    elif app_bytes[:4] == '\x00\x04\x04\x01':  # Cluster: Illuminance Measurement (0x0400), Profile: Home Automation (0x0104)
+        if cluster_bytes[-5:-2] == '\x00\x00\x21':  # Measured Value, 16-Bit Unsigned Int
+            luminance_raw = unpack('<h', cluster_bytes[-2:])[0]
+            readings.append((READING_LUMINANCE, source, luminance_raw * LUMINANCE_TO_LUX))
+        else:
+            warnings.append("Unknown Luminance packet. Cluster: %s" % cluster_bytes.encode('hex'))
+    elif app_bytes[:4] == '\x02\x04\x04\x01':  # Cluster: Temperature Measurement (0x0402), Profile: Home Automation (0x0104)
+        if cluster_bytes[-5:-2] == '\x00\x00\x29':  # Measured Value, 16-Bit Signed Int
+            temperature_raw = unpack('<h', cluster_bytes[-2:])[0]
+            readings.append((READING_TEMPERATURE, source, celsius_to_fahrenheit(temperature_raw / 100.0)))
+        else:
+            warnings.append("Unknown Temperature packet. Cluster: %s" % cluster_bytes.encode('hex'))
+
+    return readings, warnings
+
+def init_decode_worker(network_key):
+    '''Initializer for a multiprocessing.Pool of decode workers'''
+    global _worker_network_key
+    _worker_network_key = network_key
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent process handles interrupts and shuts the pool down
+
+def decode_sensor_frame_in_worker(frame):
+    '''
+    decode_sensor_frame, with the network key given init_decode_worker
+    :return: None if decoding raised, e.g: kbdecrypt on a malformed frame, so one frame can't fail its whole batch
+    '''
+    try:
+        return decode_sensor_frame(frame, _worker_network_key)
+    except Exception:
+        return None
@@ -0,0 +1,165 @@
+"""
+Reads the few header fields zigbee.py filters on straight from raw 802.15.4 frame bytes, with offset arithmetic,
+so frames from devices other than our sensors, and frames already seen, are dropped without a scapy dissection.
+
+Note this must stay a python 2 compatible module: zigbee.py imports it
+"""
+
+import struct
+import time
+
+# IEEE 802.15.4 MAC frame control field
+MAC_FRAME_TYPE_MASK = 0x0007
+MAC_FRAME_TYPE_DATA = 0x0001
+MAC_SECURITY_ENABLED = 0x0008
+MAC_PAN_ID_COMPRESSION = 0x0040
+MAC_DST_ADDR_MODE_SHIFT = 10
+MAC_SRC_ADDR_MODE_SHIFT = 14
+MAC_ADDR_LENGTHS = {0: 0, 2: 2, 3: 8}  # Addressing mode -> address length. Mode 1 is reserved
+
+# Zigbee NWK frame control field
+NWK_FRAME_TYPE_MASK = 0x0003
+NWK_MULTICAST = 0x0100
+NWK_SECURITY = 0x0200
+NWK_SOURCE_ROUTE = 0x0400
+NWK_DST_IEEE = 0x0800
+NWK_SRC_IEEE = 0x1000
+
+# Zigbee auxiliary security header's security control field
+SECURITY_EXTENDED_NONCE = 0x20
+
+FRAME_COUNTER_RESET_WINDOW_S = 60  # Duplicates arrive within moments. After this, a lower counter is a restart
+
+# Python 2 has no monotonic clock
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def parse_nwk_security_source(frame):
+    """
+    :param frame: a raw 802.15.4 frame, as sniffed, with or without its FCS
+    :return: the extended source address and frame counter of the frame's Zigbee NWK auxiliary security header,
+    i.e: the fields of scapy's ZigbeeSecurityHeader. None if the frame has no such header with a source address,
+    or is truncated
+    """
+    try:
+        # MAC header: frame control, sequence number, then addresses per the frame control
+        mac_control = struct.unpack_from('<H', frame, 0)[0]
+        if mac_control & MAC_FRAME_TYPE_MASK != MAC_FRAME_TYPE_DATA or mac_control & MAC_SECURITY_ENABLED:
+            return None  # Zigbee secures at the NWK layer: MAC security is some other protocol
+
+        dst_addr_length = MAC_ADDR_LENGTHS.get((mac_control >> MAC_DST_ADDR_MODE_SHIFT) & 0x3)
+        src_addr_length = MAC_ADDR_LENGTHS.get((mac_control >> MAC_SRC_ADDR_MODE_SHIFT) & 0x3)
+        if dst_addr_length is None or src_addr_length is None:
+            return None
+
+        offset = 3
+        if dst_addr_length > 0:
+            offset += 2 + dst_addr_length  # PAN Id, address
+        if src_addr_length > 0:
+            if not mac_control & MAC_PAN_ID_COMPRESSION:
+                offset += 2
+            offset += src_addr_length
+
+        # NWK header: frame control, short destination and source, radius, sequence number, then optional fields
+        nwk_control = struct.unpack_from('<H', frame, offset)[0]
+        if nwk_control & NWK_FRAME_TYPE_MASK > 1 or not nwk_control & NWK_SECURITY:
+            return None  # Neither data nor command, or unsecured
+
+        offset += 8
+        if nwk_control & NWK_DST_IEEE:
+            offset += 8
+        if nwk_control & NWK_SRC_IEEE:
+            offset += 8
+        if nwk_control & NWK_MULTICAST:
+            offset += 1
+        if nwk_control & NWK_SOURCE_ROUTE:
+            relay_count = struct.unpack_from('<B', frame, offset)[0]
+            offset += 2 + 2 * relay_count
+
+        # Auxiliary security header: security control, frame counter, then the source if an extended nonce
+        security_control, frame_counter = struct.unpack_from('<BI', frame, offset)
+        if not security_control & SECURITY_EXTENDED_NONCE:
+            return None
+
+        source = struct.unpack_from('<Q', frame, offset + 5)[0]
+        return source, frame_counter
+    except struct.error:
+        return None  # Truncated
+
+
+def ieee802154_fcs(frame):
+    '''
+    :return: the 2 byte frame check sequence ending an 802.15.4 frame: the CRC-16 of ITU-T, little-endian
+    '''
+    crc = 0
+    for byte in bytearray(frame):
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+    return struct.pack('<H', crc)
+
+
+def has_valid_fcs(frame):
+    """
+    :param frame: a raw 802.15.4 frame, with its FCS
+    :return: whether the frame arrived as sent
+    """
+    return len(frame) > 2 and ieee802154_fcs(frame[:-2]) == frame[-2:]
+
+
+class FrameCounterFilter:
+    """
+    Drops frames whose NWK security frame counter isn't above the last accepted from the same source:
+    MAC retransmissions, and frames heard twice or replayed. A source silent for reset_window_s may start
+    counting again from anywhere, e.g: after losing power
+    """
+
+    def __init__(self, reset_window_s=FRAME_COUNTER_RESET_WINDOW_S):
+        self.reset_window_s = reset_window_s
+
+        self.frames_duplicate = 0
+        self.frames_unverified = 0
+        self.counter_resets = 0
+
+        self._last_counters = {}  # Source -> (frame counter, monotonic time) of the last counted frame
+
+    def accept_frame(self, frame, sources, now=None, fcs_valid=None):
+        """
+        Frames whose FCS isn't valid are accepted unless repeats, but don't count: their counter may be garbled,
+        and counting one too high would drop the source's next frames. Some radios put RSSI and LQI where the FCS goes
+
+        :param frame: a raw 802.15.4 frame, with its FCS
+        :param sources: the extended source addresses to accept frames from
+        :param now: the current monotonic time. If None, now
+        :param fcs_valid: whether the radio found the frame's FCS valid. If None, the FCS is checked
+        :return: whether the frame is from one of sources, and new
+        """
+        security_source = parse_nwk_security_source(frame)
+        if security_source is None or security_source[0] not in sources:
+            return False
+
+        if fcs_valid is None:
+            fcs_valid = has_valid_fcs(frame)
+        if not fcs_valid:
+            self.frames_unverified += 1
+        return self.accept(security_source[0], security_source[1], now, count=fcs_valid)
+
+    def accept(self, source, frame_counter, now=None, count=True):
+        """
+        :param now: the current monotonic time. If None, now
+        :param count: whether a new frame's counter becomes the source's last
+        :return: whether the frame is new
+        """
+        if now is None:
+            now = monotonic()
+
+        last = self._last_counters.get(source)
+        if last is not None and frame_counter <= last[0] and now - last[1] < self.reset_window_s:
+            self.frames_duplicate += 1
+            return False
+
+        if count:
+            if last is not None and frame_counter <= last[0]:
+                self.counter_resets += 1
+            self._last_counters[source] = (frame_counter, now)
+        return True
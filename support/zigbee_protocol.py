@@ -0,0 +1,192 @@
+"""
+The binary frames zigbee.py sends sensor readings to motion.py in, over UDP on localhost.
+
+A frame is a header followed by up to MAX_READINGS_PER_FRAME readings, all little-endian:
+    header:  version (uint8), reading count (uint8), sequence number (uint32)
+    reading: type (uint8), sensor address (uint64), value (float64), POSIX timestamp (float64)
+
+Sequence numbers count frames from 1, wrapping back to 1 after 2^32 - 1. 0 is sent by a restarted sender.
+
+Note this must stay a python 2 compatible module: zigbee.py imports it
+"""
+
+import struct
+import time
+
+PROTOCOL_VERSION = 1
+
+READING_MOTION = 1  # Value 1 for motion start, 0 for stop
+READING_LUMINANCE = 2  # Value in lux
+READING_TEMPERATURE = 3  # Value in Fahrenheit
+
+READING_TYPE_NAMES = {
+    READING_MOTION: 'motion',
+    READING_LUMINANCE: 'luminance',
+    READING_TEMPERATURE: 'temp',
+}
+
+HEADER = struct.Struct('<BBI')
+READING = struct.Struct('<BQdd')
+MAX_READINGS_PER_FRAME = 32  # 806 bytes: below any MTU, so never fragmented
+MAX_FRAME_SIZE = HEADER.size + MAX_READINGS_PER_FRAME * READING.size
+
+SEQUENCE_MODULUS = 2 ** 32
+
+BATCH_MAX_DELAY_S = 0.02  # The longest a reading waits for others to share its frame
+
+# Times batching delays. Never sent: python 2 has no monotonic clock, so zigbee.py's and motion.py's differ
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(sequence, readings):
+    """
+    :param sequence: the frame's sequence number
+    :param readings: up to MAX_READINGS_PER_FRAME (type, address, value, timestamp) tuples
+    :return: the frame's bytes
+    """
+    if len(readings) > MAX_READINGS_PER_FRAME:
+        raise ProtocolError("%d readings exceed the %d a frame holds" % (len(readings), MAX_READINGS_PER_FRAME))
+
+    parts = [HEADER.pack(PROTOCOL_VERSION, len(readings), sequence)]
+    for reading in readings:
+        parts.append(READING.pack(*reading))
+    return b''.join(parts)
+
+
+def decode_frame(data):
+    """
+    :return: the frame's sequence number, and its list of (type, address, value, timestamp) readings
+    """
+    if len(data) < HEADER.size:
+        raise ProtocolError("Frame of %d bytes is shorter than its header" % len(data))
+
+    version, count, sequence = HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError("Unsupported frame version %d" % version)
+    if len(data) != HEADER.size + count * READING.size:
+        raise ProtocolError("Frame of %d bytes can't hold its %d readings" % (len(data), count))
+
+    readings = [READING.unpack_from(data, HEADER.size + idx * READING.size) for idx in range(count)]
+    return sequence, readings
+
+
+class FrameSender:
+    """
+    Batches readings into frames, sending a frame once full or once its first reading waited BATCH_MAX_DELAY_S
+    """
+
+    def __init__(self, sock, address, max_delay_s=BATCH_MAX_DELAY_S):
+        """
+        :param sock: a UDP socket
+        :param address: the receiver's (host, port)
+        """
+        self.sock = sock
+        self.address = address
+        self.max_delay_s = max_delay_s
+
+        self.sequence = 0
+        self.frames_sent = 0
+        self.readings_sent = 0
+
+        self._readings = []
+        self._first_reading_time = None
+
+        self._send([])  # Tell the receiver the sequence restarted
+
+    def add(self, type, address, value, timestamp=None):
+        """
+        Queue a reading, sending the frame if it's full
+        :param type: one of the READING_ constants
+        :param timestamp: when the reading was taken, per time.time(). If None, now
+        """
+        self._readings.append((type, address, float(value), timestamp if timestamp is not None else time.time()))
+        if self._first_reading_time is None:
+            self._first_reading_time = monotonic()
+
+        if len(self._readings) >= MAX_READINGS_PER_FRAME:
+            self.flush()
+
+    def flush_if_due(self):
+        """
+        Send the queued readings if the first has waited max_delay_s. Call regularly
+        """
+        if self._first_reading_time is not None and monotonic() - self._first_reading_time >= self.max_delay_s:
+            self.flush()
+
+    def flush(self):
+        if len(self._readings) == 0:
+            return
+
+        readings = self._readings
+        self._readings = []
+        self._first_reading_time = None
+
+        self.sequence = self.sequence % (SEQUENCE_MODULUS - 1) + 1
+        self._send(readings)
+        self.frames_sent += 1
+        self.readings_sent += len(readings)
+
+    def _send(self, readings):
+        self.sock.sendto(encode_frame(self.sequence, readings), self.address)
+
+
+class SequenceTracker:
+    """
+    Detects frames lost or reordered between a FrameSender and its receiver
+    """
+
+    def __init__(self):
+        self.last_sequence = None
+        self.frames_received = 0
+        self.frames_dropped = 0  # Skipped sequence numbers. Includes frames that later arrived late
+        self.frames_late = 0
+
+    def track(self, sequence):
+        """
+        :return: the number of frames found lost between the last frame and this one
+        """
+        self.frames_received += 1
+
+        if sequence == 0:
+            self.last_sequence = 0  # The sender restarted
+            return 0
+
+        if self.last_sequence is None:
+            self.last_sequence = sequence
+            return 0
+
+        # Distance forward from the last frame, across the wrap from 2^32 - 1 back to 1
+        gap = (sequence - self.last_sequence - 1) % (SEQUENCE_MODULUS - 1)
+        if gap >= (SEQUENCE_MODULUS - 1) // 2:
+            self.frames_late += 1  # Behind the last frame: late, or duplicated
+            return 0
+
+        self.last_sequence = sequence
+        self.frames_dropped += gap
+        return gap
+
+
+class ReadingFileWriter:
+    """
+    Writes readings to a file, one per line, in place of a FrameSender. Lines hold the type name, address and value,
+    but no timestamp, so decoding the same capture twice writes the same file
+    """
+
+    def __init__(self, path, max_delay_s=BATCH_MAX_DELAY_S):
+        self.file = open(path, 'w')
+        self.max_delay_s = max_delay_s
+        self.readings_sent = 0
+
+    def add(self, type, address, value, timestamp=None):
+        self.file.write("%s %d %r\n" % (READING_TYPE_NAMES[type], address, float(value)))
+        self.readings_sent += 1
+
+    def flush_if_due(self):
+        pass
+
+    def flush(self):
+        self.file.flush()
@@ -9,7 +9,7 @@ from gevent import pywsgi
 from settings import ROOMS
 from support import env
 from support.color import get_current_circadian_color
-from support.hue import command_all_lights, COMMAND_FULL_ON
+from support.hue import command_all_lights, provision_room_groups, COMMAND_FULL_ON
 from support.logger import get_logger
 from support.time_utils import get_local_time
 
@@ -20,17 +20,20 @@ logger = get_logger("web_server")
 party_process = None  # Party mode process
 
 
-def get_home_status(template_friendly_dict: bool) -> dict:
+def get_home_status(template_friendly_dict: bool, snapshot: env.HomeSnapshot = None) -> dict:
     """
     :param template_friendly_dict: whether to create a template friendly dict. This involves representing booleans
     as "true"/"false" strings and stripping spaces from keys. For template dicts,
     we need to use string values, for json return we can use bool
+    :param snapshot: the home state to report room occupancy from. If None, a new one is read
     """
+    if snapshot is None:
+        snapshot = env.snapshot()
 
     home_status = {}
     for room in ROOMS:
         lit = room.is_lit()
-        occupied = env.get_room_occupied(room.name)
+        occupied = snapshot.get_room_occupied(room.name)
         key = room.name
         if template_friendly_dict:
             lit = "true" if lit else "false"
@@ -125,11 +128,12 @@ def home_status():
 
 @app.route("/", methods=['GET'])
 def home():
-    home_status_json = get_home_status(template_friendly_dict=False)  # Template engine requires string values
-    guest_mode = 'true' if env.is_guest_mode() else 'false'
-    party_mode = 'true' if env.is_party_mode() else 'false'
-    motion_mode = 'true' if env.is_motion_enabled() else 'false'
-    vacation_mode = 'true' if env.is_vacation_mode() else 'false'
+    snapshot = env.snapshot()
+    home_status_json = get_home_status(template_friendly_dict=False, snapshot=snapshot)  # Template engine requires string values
+    guest_mode = 'true' if snapshot.is_guest_mode() else 'false'
+    party_mode = 'true' if snapshot.is_party_mode() else 'false'
+    motion_mode = 'true' if snapshot.is_motion_enabled() else 'false'
+    vacation_mode = 'true' if snapshot.is_vacation_mode() else 'false'
 
     return flask.render_template('home.html',
                                  home_status=home_status_json,
@@ -142,6 +146,7 @@ def home():
 if __name__ == "__main__":
 
     env.set_party_mode(False)
+    provision_room_groups({room.name: room.lights for room in ROOMS})
 
     server = pywsgi.WSGIServer(('0.0.0.0', 5000), app)
     server.serve_forever()
@@ -2,18 +2,17 @@ from datetime import datetime, timedelta
 import sys
 import signal
 import socket
-from struct import *
 import argparse
-import os
-
-from scapy.all import *
-from killerbee import *
-from killerbee.scapy_extensions import *
+import time
+from multiprocessing import Pool, TimeoutError, cpu_count
 
 from support.logger import get_logger
 from support.zigbee_addrs import SENSOR_ADDR_TO_NAME
-
-from usb.util import dispose_resources
+from support.zigbee_capture import CaptureThread, FrameRing, read_pcap_frames
+from support.zigbee_decode import decode_sensor_frame_in_worker, init_decode_worker
+from support.zigbee_frames import FrameCounterFilter
+from support.zigbee_protocol import FrameSender, ReadingFileWriter, READING_MOTION, READING_LUMINANCE, \
+    READING_TEMPERATURE
 
 # Logging
 logger = get_logger("zigbee")
@@ -21,126 +20,202 @@ logger = get_logger("zigbee")
 '''
 Note because of killerbee this must be a python 2 module.
 We'll relate events over UDP to our python3 processes
-'''
 
-def detect_encryption(pkt):
-    '''detect_entryption: Does this packet have encrypted information? Return: True or False'''
-    if not pkt.haslayer(ZigbeeSecurityHeader) or not pkt.haslayer(ZigbeeNWK):
-        return False
-    return True
-
-def detect_layer(pkt, layer):
-    '''detect_entryption: Does this packet have encrypted information? Return: True or False'''
-    # if not pkt.haslayer(ZigbeeAppDataPayload):
-    if not pkt.haslayer(layer):
-        return False
-    return True
+Frames flow from the radio to a capture thread, through a FrameRing, to a pool of decode
+processes, and back to this process's main thread, which forwards readings to motion.py.
+With --pcap, frames are read from a capture file instead, as fast as they decode.
+'''
 
 def interrupt(signum, frame):
     global packetcount
     global kb
-    kb.sniffer_off()
-    kb.close()
+    if capture is not None:
+        capture.stop()
+    sender.flush()
+    decode_pool.terminate()
+    if kb is not None:
+        kb.sniffer_off()
+        kb.close()
 
     logger.info("{0} Zigbee packets captured".format(packetcount))
+    log_frame_counts()
     sys.exit(0)
 
+def log_frame_counts():
+    logger.info("Zigbee frames: {0} seen, {1} filtered before dissection ({2} duplicates), {3} with an unverified "
+                "FCS, {4} decoded, {5} lost to a full buffer".format(
+        frames_seen + (capture.frames_seen if capture else 0),
+        frames_filtered + (capture.frames_filtered if capture else 0),
+        frame_counters.frames_duplicate,
+        frame_counters.frames_unverified,
+        frames_decoded,
+        ring.overflowed if ring else 0))
+
+def is_sensor_frame(frame, fcs_valid=None, now=None):
+    '''Most traffic is bulbs and the bridge. Read the NWK security source from the raw bytes, and only
+    dissect what our sensors sent. Sensors retransmit, so drop frames whose counter we've seen before
+    decrypting them too. now is when the frame was captured, if not just now'''
+    return frame_counters.accept_frame(frame, SENSOR_ADDR_TO_NAME, now=now, fcs_valid=fcs_valid)
+
+def on_reading(reading_type, source, value):
+    name = SENSOR_ADDR_TO_NAME[source]
+    if reading_type == READING_MOTION:
+        is_motion_start = value
+        if source in last_motion_map and (is_motion_start == last_motion_map[source]):
+            #  Duplicate frames are already gone: this is the sensor reporting unchanged occupancy
+            return
+        logger.info("%s motion %r" % (name, is_motion_start))
+        sender.add(READING_MOTION, source, is_motion_start)
+        sender.flush()  # Lights wait on motion: don't hold it for a batch
+        last_motion_map[source] = is_motion_start
+    elif reading_type == READING_LUMINANCE:
+        logger.info("Room %s luminance %f" % (name, value))
+        sender.add(READING_LUMINANCE, source, value)
+    elif reading_type == READING_TEMPERATURE:
+        logger.info("Room %s Temperature %f Fahrenheit" % (name, value))
+        sender.add(READING_TEMPERATURE, source, value)
+
+def decode_frames(frames, chunk_size=1):
+    '''Decode frames on the pool and forward their readings'''
+    global packetcount
+    global frames_decoded
+
+    # map keeps the frames' order, so motion starts and stops are forwarded as they happened.
+    # get() with a timeout, as python 2 can't interrupt an untimed wait
+    try:
+        decoded = decode_pool.map_async(decode_sensor_frame_in_worker, frames, chunk_size).get(DECODE_TIMEOUT_S)
+    except TimeoutError:
+        logger.error("Decoding {0} Zigbee frames took over {1} s. Dropped them".format(len(frames), DECODE_TIMEOUT_S))
+        return
+
+    for frame, decoded_frame in zip(frames, decoded):
+        packetcount += 1
+        if decoded_frame is None:
+            logger.warn("Failed to decode Zigbee frame: %s" % frame.encode('hex'))
+            continue
+        readings, warnings = decoded_frame
+        frames_decoded += 1
+        for warning in warnings:
+            logger.warn(warning)
+        for reading_type, source, value in readings:
+            on_reading(reading_type, source, value)
+
+def run_live():
+    global kb
+    global ring
+    global capture
+    global frame_counts_logged
+    global frames_overflowed_logged
+
+    from killerbee import KillerBee
+
+    subghz_page = 0
+    device = None # Auto select?
+    kb = KillerBee(device=device)
+    if not kb.is_valid_channel(channel, subghz_page):
+        logger.error("ERROR: Must specify a valid IEEE 802.15.4 channel for the selected device.")
+        kb.close()
+        decode_pool.terminate()
+        sys.exit(1)
+    kb.set_channel(channel, subghz_page)
+    kb.sniffer_on()
+
+    rf_freq_mhz = kb.frequency(channel, subghz_page) / 1000.0
+    logger.info(
+        "Zigbee: listening on \'{0}\', channel {1}, page {2} ({3} MHz), link-type DLT_IEEE802_15_4, capture size 127 bytes".format(
+            kb.get_dev_info()[0], channel, subghz_page, rf_freq_mhz))
+
+    ring = FrameRing()
+    capture = CaptureThread(kb, ring, is_sensor_frame, logger)
+    capture.start()
+
+    while True:
+        sender.flush_if_due()
+        if datetime.now() - frame_counts_logged > FRAME_COUNTS_LOG_INTERVAL:
+            log_frame_counts()
+            frame_counts_logged = datetime.now()
+        if ring.overflowed > frames_overflowed_logged:
+            logger.warn("Lost {0} Zigbee frames to a full capture buffer, {1} in all".format(
+                ring.overflowed - frames_overflowed_logged, ring.overflowed))
+            frames_overflowed_logged = ring.overflowed
+
+        # Wake at least as often as batched readings are due to be sent
+        frames = ring.take(DECODE_BATCH_SIZE, timeout_s=sender.max_delay_s)
+        if len(frames) > 0:
+            decode_frames(frames)
+
+def run_offline(pcap_path):
+    global frames_seen
+    global frames_filtered
+
+    started = time.time()
+    batch = []
+    for frame, captured in read_pcap_frames(pcap_path):
+        frames_seen += 1
+        # A capture replays far faster than it was recorded: time counter resets by the capture's clock
+        if not is_sensor_frame(frame, now=captured):
+            frames_filtered += 1
+            continue
+
+        batch.append(frame)
+        if len(batch) >= OFFLINE_BATCH_SIZE:
+            decode_frames(batch, OFFLINE_CHUNK_SIZE)
+            batch = []
+    decode_frames(batch, OFFLINE_CHUNK_SIZE)
+    sender.flush()
+
+    elapsed_s = max(time.time() - started, 1e-6)
+    log_frame_counts()
+    logger.info("Decoded {0} in {1:.2f} s: {2:.0f} frames/s read, {3:.0f} frames/s decoded, {4} readings".format(
+        pcap_path, elapsed_s, frames_seen / elapsed_s, frames_decoded / elapsed_s, sender.readings_sent))
+
+parser = argparse.ArgumentParser(description="Forwards Zigbee sensor readings to motion.py")
+parser.add_argument('--pcap', help="decode this 802.15.4 pcap or pcapng capture as fast as possible, instead of a radio")
+parser.add_argument('--output', help="write readings to this file, one per line, instead of sending them over UDP")
+args = parser.parse_args()
+
 last_motion_map = {}
+frame_counters = FrameCounterFilter()
 
 # UDP
 UDP_IP = "127.0.0.1"
 UDP_PORT = 5005 # Ugh can't import from python3 land
-sock = socket.socket(socket.AF_INET, # Internet
-                     socket.SOCK_DGRAM) # UDP
+if args.output:
+    sender = ReadingFileWriter(args.output)
+else:
+    sock = socket.socket(socket.AF_INET, # Internet
+                         socket.SOCK_DGRAM) # UDP
+    sender = FrameSender(sock, (UDP_IP, UDP_PORT))
+
+# Decoding
+DECODE_WORKERS = max(1, cpu_count() - 1)  # Leave a core to capture and forward
+DECODE_BATCH_SIZE = 16  # Frames handed to the pool at once
+DECODE_TIMEOUT_S = 60
+OFFLINE_CHUNK_SIZE = 64  # Frames sent to a worker at once when decoding a capture
+OFFLINE_BATCH_SIZE = OFFLINE_CHUNK_SIZE * DECODE_WORKERS * 4
 
 # Global
 packetcount = 0
+frames_seen = 0  # Read from a capture file. See CaptureThread for the radio's
+frames_filtered = 0
+frames_decoded = 0  # Dissected with scapy
+FRAME_COUNTS_LOG_INTERVAL = timedelta(minutes=10)
+frame_counts_logged = datetime.now()
+frames_overflowed_logged = 0
 network_key = "270aa9e33947363feea6e52167c107cf".decode('hex')
 channel = 25
 
-subghz_page = 0
-device = None # Auto select?
-kb = KillerBee(device=device)
-signal.signal(signal.SIGINT, interrupt)
-if not kb.is_valid_channel(channel, subghz_page):
-    logger.error("ERROR: Must specify a valid IEEE 802.15.4 channel for the selected device.")
-    kb.close()
-    sys.exit(1)
-kb.set_channel(channel, subghz_page)
-kb.sniffer_on()
-
-rf_freq_mhz = kb.frequency(channel, subghz_page) / 1000.0
-logger.info(
-    "Zigbee: listening on \'{0}\', channel {1}, page {2} ({3} MHz), link-type DLT_IEEE802_15_4, capture size 127 bytes".format(
-        kb.get_dev_info()[0], channel, subghz_page, rf_freq_mhz))
-
-# Unit conversion constants
+kb = None
+ring = None
+capture = None
 
-LUMINANCE_TO_LUX = 0.0010171925257971555
-
-def celsius_to_fahrenheit(celsius):
-    return (celsius * 9 / 5.0) + 32
+# Fork decode workers before opening the radio, so they don't inherit its USB handle
+decode_pool = Pool(DECODE_WORKERS, initializer=init_decode_worker, initargs=(network_key,))
+signal.signal(signal.SIGINT, interrupt)
 
-while True:
-    scapy_packet = None
-    try:
-        packet = kb.pnext(timeout=0)
-        # packet[1] is True if CRC is correct, check removed to have promiscous capture regardless of CRC
-        # if PAN filter active, only process correct PAN or ACK
-        scapy_packet = Dot15d4FCS(packet['bytes'])
-    except:
-        if packet:
-            logger.error("Unable to parse 802.15.4 packet: %s" % packet['bytes'].encode('hex'))
-        else:
-            logger.exception("Unable to fetch packet")
-        continue
-    if scapy_packet is not None:  # and packet[1]:
-        packetcount += 1
-        # unbuffered.write("Packet " + packet['bytes'].encode('hex') + "\n")
-        if detect_layer(scapy_packet, ZigbeeSecurityHeader):
-            source = scapy_packet.getlayer(ZigbeeSecurityHeader).fields['source']
-            if source in SENSOR_ADDR_TO_NAME:
-                # Data from motion sensor
-                name = SENSOR_ADDR_TO_NAME[source]
-                if detect_encryption(scapy_packet):
-                    enc_data = kbdecrypt(scapy_packet, network_key)
-                    # First determine if this is an occupancy sensing
-                    if detect_layer(enc_data, ZigbeeAppDataPayload) and detect_layer(enc_data,
-                                                                                     ZigbeeClusterLibrary):
-                        app_bytes = enc_data.getlayer(ZigbeeAppDataPayload).payload.__bytes__()
-                        cluster_bytes = enc_data.getlayer(ZigbeeClusterLibrary).payload.__bytes__()
-                        # Occupancy Sensing
-                        if app_bytes[:4] == '\x06\x04\x04\x01':  # Cluster: Occupancy Sensing (0x0406), Profile: Home Automation (0x0104)
-                            # print "\t"*3 + "enc cluster: " + str(cluster) + " raw: " + enc_data.getlayer(a).payload.__bytes__().encode('hex')
-                            if cluster_bytes[-4:-1] == '\x00\x00\x18':  # Occupancy Sensing, 8-Bit bitmap
-                                is_motion_start = cluster_bytes[-1] == '\x01'
-                                if source in last_motion_map and (is_motion_start == last_motion_map[source]):
-                                    #  Ignore duplicate events
-                                    continue
-                                logger.info("%s motion %r" % (name, is_motion_start))
-                                sock.sendto("motion-%d-%d" % (source, is_motion_start), (UDP_IP, UDP_PORT))
-                                last_motion_map[source] = is_motion_start
-                            else:
-                                logger.warn("Unknown Motion packet. Cluster: %s" % cluster_bytes.encode('hex'))
-                        elif app_bytes[:4] == '\x00\x04\x04\x01':  # Cluster: Illuminance Measurement (0x0400), Profile: Home Automation (0x0104)
-                            if cluster_bytes[-5:-2] == '\x00\x00\x21':  # Measured Value, 16-Bit Unsigned Int
-                                luminance_raw = unpack('<h', cluster_bytes[-2:])[0]
-                                luminance_lux = luminance_raw * LUMINANCE_TO_LUX
-                                logger.info("Room %s luminance %f" % (name, luminance_lux))
-                                sock.sendto("luminance-%d-%f" % (source, luminance_lux), (UDP_IP, UDP_PORT))
-                            else:
-                                logger.warn("Unknown Luminance packet. Cluster: %s" % cluster_bytes.encode('hex'))
-                        elif app_bytes[
-                             :4] == '\x02\x04\x04\x01':  # Cluster: Temperature Measurement (0x0402), Profile: Home Automation (0x0104)
-                            if cluster_bytes[-5:-2] == '\x00\x00\x29':  # Measured Value, 16-Bit Signed Int
-                                temperature_raw = unpack('<h', cluster_bytes[-2:])[0]
-                                temp_celsius = temperature_raw / 100.0
-                                temp_fahrenheit = celsius_to_fahrenheit(temp_celsius)
-                                logger.info("Room %s Temperature %f Fahrenheit" % (name, temp_fahrenheit))
-                                sock.sendto("temp-%d-%f" % (source, temp_fahrenheit), (UDP_IP, UDP_PORT))
-                            else:
-                                logger.warn("Unknown Temperature packet. Cluster: %s" % cluster_bytes.encode('hex'))
-kb.sniffer_off()
-kb.close()
-
-logger.info("{0} packets captured".format(packetcount))
+if args.pcap:
+    run_offline(args.pcap)
+    decode_pool.close()
+    decode_pool.join()
+else:
+    run_live()
@@ -0,0 +1,79 @@
+"""
+Checks FrameCounterFilter against hand built sensor frames. Exits non-zero if not::
+
+    python zigbee_frames_test.py
+
+Note this must stay python 2 compatible, like support.zigbee_frames
+"""
+
+import struct
+import unittest
+
+from support.zigbee_frames import FrameCounterFilter, ieee802154_fcs, parse_nwk_security_source
+
+SENSOR = 0x0017880103aabbcc
+OTHER_DEVICE = 0x0017880103ddeeff
+
+
+def make_frame(source, frame_counter):
+    '''
+    :return: a Zigbee data frame from source, as a sensor sends it: NWK secured, short MAC addresses, with FCS
+    '''
+    mac_header = struct.pack('<HBHHH', 0x8841, 1, 0x1a62, 0x0000, 0x1234)  # Data, PAN Id compression, short addresses
+    nwk_header = struct.pack('<HHHBB', 0x0208, 0x0000, 0x1234, 30, 1)  # Data, security, protocol version 2
+    security_header = struct.pack('<BIQB', 0x28, frame_counter, source, 0)  # Network key, extended nonce
+    frame = mac_header + nwk_header + security_header + b'\x5a' * 8 + b'\x00' * 4  # Payload, MIC
+    return frame + ieee802154_fcs(frame)
+
+
+def corrupt(frame, offset):
+    flipped = bytearray(frame)
+    flipped[offset] ^= 0xff
+    return bytes(flipped)
+
+
+class FrameCounterFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = FrameCounterFilter(reset_window_s=60)
+
+    def test_drops_repeated_counters(self):
+        self.assertTrue(self.filter.accept_frame(make_frame(SENSOR, 10), [SENSOR], now=0))
+        self.assertFalse(self.filter.accept_frame(make_frame(SENSOR, 10), [SENSOR], now=1))
+        self.assertTrue(self.filter.accept_frame(make_frame(SENSOR, 11), [SENSOR], now=2))
+        self.assertEqual(self.filter.frames_duplicate, 1)
+
+    def test_drops_other_sources(self):
+        self.assertFalse(self.filter.accept_frame(make_frame(OTHER_DEVICE, 10), [SENSOR], now=0))
+
+    def test_corrupted_counter_does_not_suppress_next_frame(self):
+        self.assertTrue(self.filter.accept_frame(make_frame(SENSOR, 10), [SENSOR], now=0))
+
+        # The counter's top byte garbled in the air, so it reads far above the sensor's real counter
+        corrupted = corrupt(make_frame(SENSOR, 11), 21)
+        self.assertGreater(parse_nwk_security_source(corrupted)[1], 11)
+        self.assertTrue(self.filter.accept_frame(corrupted, [SENSOR], now=1))  # Still decoded, but not counted
+        self.assertEqual(self.filter.frames_unverified, 1)
+
+        self.assertTrue(self.filter.accept_frame(make_frame(SENSOR, 11), [SENSOR], now=2))
+
+    def test_drops_repeats_with_unverified_fcs(self):
+        self.assertTrue(self.filter.accept_frame(make_frame(SENSOR, 10), [SENSOR], now=0))
+        self.assertFalse(self.filter.accept_frame(corrupt(make_frame(SENSOR, 10), -1), [SENSOR], now=1))
+
+    def test_counts_frames_the_radio_verified(self):
+        # e.g: a radio that puts RSSI and LQI where the FCS goes, and reports the CRC separately
+        frame = make_frame(SENSOR, 10)[:-2] + b'\xc4\x80'
+        self.assertTrue(self.filter.accept_frame(frame, [SENSOR], now=0, fcs_valid=True))
+        self.assertFalse(self.filter.accept_frame(frame, [SENSOR], now=1, fcs_valid=True))
+        self.assertEqual(self.filter.frames_unverified, 0)
+
+    def test_restarted_counter_accepted_after_window(self):
+        self.assertTrue(self.filter.accept_frame(make_frame(SENSOR, 1000), [SENSOR], now=0))
+        self.assertFalse(self.filter.accept_frame(make_frame(SENSOR, 1), [SENSOR], now=30))
+        self.assertTrue(self.filter.accept_frame(make_frame(SENSOR, 1), [SENSOR], now=61))
+        self.assertEqual(self.filter.counter_resets, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()